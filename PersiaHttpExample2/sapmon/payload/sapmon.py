@@ -7,89 +7,17 @@
 #
 
 # Python modules
+import signal
 import threading
+import time
 
 # Payload modules
+from shared_code.collector import initLogAnalytics, loadConfig, makeScheduler, refreshConfig
 from shared_code.providerfactory import *
 from shared_code.updatefactory import *
 
 ###############################################################################
 
-class ProviderInstanceThread(threading.Thread):
-   def __init__(self, providerInstance):
-      threading.Thread.__init__(self)
-      self.providerInstance = providerInstance
-
-   def run(self):
-      global ctx, tracer
-      for check in self.providerInstance.checks:
-         tracer.info("starting check %s" % (check.fullName))
-
-         # Skip this check if it's not enabled or not due yet
-         if (check.isEnabled() == False) or (check.isDue() == False):
-            continue
-
-         # Run all actions that are part of this check
-         resultJson = check.run()
-
-         # Ingest result into Log Analytics
-         ctx.azLa.ingest(check.customLog,
-                         resultJson,
-                         check.colTimeGenerated)
-
-         # Persist updated internal state to provider state file
-         self.providerInstance.writeState()
-
-         # Ingest result into Customer Analytics
-         enableCustomerAnalytics = ctx.globalParams.get("enableCustomerAnalytics", True)
-         if enableCustomerAnalytics and check.includeInCustomerAnalytics:
-             tracing.ingestCustomerAnalytics(tracer,
-                                             ctx,
-                                             check.customLog,
-                                             resultJson)
-         tracer.info("finished check %s" % (check.fullName))
-      return
-
-###############################################################################
-
-# Load entire config from KeyVault (global parameters and provider instances)
-def loadConfig() -> bool:
-   global ctx, tracer
-   tracer.info("loading config from KeyVault")
-
-   secrets = ctx.azKv.getCurrentSecrets()
-   for secretName in secrets.keys():
-      tracer.debug("parsing KeyVault secret %s" % secretName)
-      secretValue = secrets[secretName]
-      try:
-         providerProperties = json.loads(secretValue)
-      except json.decoder.JSONDecodeError as e:
-         tracer.error("invalid JSON format for secret %s (%s)" % (secretName,
-                                                                  e))
-         continue
-      if secretName == CONFIG_SECTION_GLOBAL:
-         ctx.globalParams = providerProperties
-         tracer.debug("successfully loaded global config")
-      else:
-         instanceName = providerProperties.get("name", None)
-         providerType = providerProperties.get("type", None)
-         try:
-            providerInstance = ProviderFactory.makeProviderInstance(providerType,
-                                                                    tracer,
-                                                                    ctx,
-                                                                    providerProperties,
-                                                                    skipContent = False)
-         except Exception as e:
-            tracer.error("could not validate provider instance %s (%s)" % (instanceName,
-                                                                           e))
-            continue
-         ctx.instances.append(providerInstance)
-         tracer.debug("successfully loaded config for provider instance %s" % instanceName)
-   if ctx.globalParams == {} or len(ctx.instances) == 0:
-      tracer.error("did not find any provider instances in KeyVault")
-      return False
-   return True
-
 # Save specific instance properties to customer KeyVault
 def saveInstanceToConfig(instance: Dict[str, str]) -> bool:
    global ctx, tracer
@@ -195,29 +123,69 @@ def monitor(args: str) -> None:
    global ctx, tracer
    tracer.info("starting monitor payload")
 
-   threads = []
-   if not loadConfig():
+   if not loadConfig(tracer, ctx, ctx.configSnapshot.refresh()):
       tracer.critical("failed to load config from KeyVault")
       sys.exit(ERROR_LOADING_CONFIG)
-   logAnalyticsWorkspaceId = ctx.globalParams.get("logAnalyticsWorkspaceId", None)
-   logAnalyticsSharedKey = ctx.globalParams.get("logAnalyticsSharedKey", None)
-   if not logAnalyticsWorkspaceId or not logAnalyticsSharedKey:
-      tracer.critical("global config must contain logAnalyticsWorkspaceId and logAnalyticsSharedKey")
+   if not initLogAnalytics(tracer, ctx):
       sys.exit(ERROR_GETTING_LOG_CREDENTIALS)
-   ctx.azLa = AzureLogAnalytics(tracer,
-                                logAnalyticsWorkspaceId,
-                                logAnalyticsSharedKey)
-   for i in ctx.instances:
-      thread = ProviderInstanceThread(i)
-      thread.start()
-      threads.append(thread)
 
-   for t in threads:
-      t.join()
+   # Run all due checks through the central scheduler (by default a single pass,
+   # since this script is started periodically)
+   scheduler = makeScheduler(tracer,
+                             ctx,
+                             windowSecs = ctx.globalParams.get("schedulerWindowSecs", 0))
+   scheduler.addInstances(ctx.instances)
+   scheduler.run()
 
    tracer.info("monitor payload successfully completed")
    return
 
+# Run the monitoring payload as a resident collector: clients, connections and provider instances
+# are kept in memory, the config is reloaded once its cache TTL has expired (and only changed
+# provider instances are replaced), and SIGTERM/SIGINT stop it after a final state checkpoint
+def daemon(args: str) -> None:
+   global ctx, tracer
+   tracer.info("starting monitor daemon")
+   stopEvent = threading.Event()
+   schedulers = []
+
+   def onSignal(signum: int, frame) -> None:
+      tracer.info("received signal %d, stopping monitor daemon" % signum)
+      stopEvent.set()
+      for scheduler in schedulers:
+         scheduler.stop()
+   signal.signal(signal.SIGTERM, onSignal)
+   signal.signal(signal.SIGINT, onSignal)
+
+   while not stopEvent.is_set():
+      cycleStartTime = time.monotonic()
+      if not refreshConfig(tracer, ctx):
+         tracer.critical("failed to load config from KeyVault")
+         sys.exit(ERROR_LOADING_CONFIG)
+      if not initLogAnalytics(tracer, ctx):
+         sys.exit(ERROR_GETTING_LOG_CREDENTIALS)
+
+      # Run all checks that are due within this cycle (checks with a short frequency repeatedly)
+      cycleSecs = ctx.globalParams.get("daemonCycleSecs", DAEMON_CYCLE_SECS)
+      scheduler = makeScheduler(tracer,
+                                ctx,
+                                windowSecs = cycleSecs)
+      scheduler.addInstances(ctx.instances)
+      schedulers[:] = [scheduler]
+      if stopEvent.is_set():
+         break
+      scheduler.run()
+      stopEvent.wait(max(0, cycleSecs - (time.monotonic() - cycleStartTime)))
+
+   # Checkpoint the state of all provider instances and release their connections
+   tracer.info("writing state checkpoint of %d provider instances" % len(ctx.instances))
+   for providerInstance in ctx.instances:
+      providerInstance.writeState()
+   if ctx.reconciler:
+      ctx.reconciler.teardownAll()
+   tracer.info("monitor daemon stopped")
+   return
+
 # prepareUpdate will prepare the resources like keyvault, log analytics etc for the version passed as an argument
 # prepareUpdate needs to be run when a version upgrade requires specific update to the content of the resources
 def prepareUpdate(args: str) -> None:
@@ -310,6 +278,13 @@ def main() -> None:
    addVerboseToParser(monParser)
    monParser.set_defaults(func = monitor)
 
+   # Parsers for "daemon" command
+   dmnParser = subParsers.add_parser("daemon",
+                                     description = "Resident monitoring payload",
+                                     help = "Execute the monitoring payload continuously in a single process")
+   addVerboseToParser(dmnParser)
+   dmnParser.set_defaults(func = daemon)
+
    # Parsers for "onboard" command
    onbParser = subParsers.add_parser("onboard",
                                      description = "Onboard payload",
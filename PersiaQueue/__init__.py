@@ -1,8 +1,40 @@
 import logging
+import sys
 
-import azure.functions as func
+from ..shared_code import context
+from ..shared_code import tracing
+from ..shared_code import collector, const
+from ..shared_code.cache import workerCache
+from ..shared_code.lease import LeaseManager
 
+import azure.functions as func
+###############################################################################
 
+# Collect a single provider instance, as dispatched by the timer function (collection mode "dispatch")
 def main(msg: func.QueueMessage) -> None:
-    logging.info('Persia testing Python queue trigger function processed a queue item: %s',
-                 msg.get_body().decode('utf-8'))
+    global ctx, tracer
+    workItemJson = msg.get_body().decode('utf-8')
+    logging.info('processing work item %s (dequeueCount=%s)', workItemJson, msg.dequeue_count)
+
+    # Tracer, context and provider instances are shared with the timer function of the same worker
+    tracer = workerCache.getOrCreate(const.CACHE_KEY_TRACER,
+                                     tracing.tracing.initTracer)
+    previousCtx = ctx
+    ctx = workerCache.getOrCreate(const.CACHE_KEY_CONTEXT,
+                                  lambda: context.Context(tracer, "monitor"),
+                                  const.CACHE_TTL_CONTEXT_SECS)
+    # Release the provider instances of an expired context
+    if previousCtx and previousCtx is not ctx and previousCtx.reconciler:
+       previousCtx.reconciler.teardownAll()
+    leases = workerCache.getOrCreate(const.CACHE_KEY_LEASES,
+                                     lambda: LeaseManager(tracer))
+
+    if not collector.refreshConfig(tracer, ctx):
+       tracer.critical("failed to load config from KeyVault")
+       sys.exit(const.ERROR_LOADING_CONFIG)
+    if not collector.initLogAnalytics(tracer, ctx):
+       sys.exit(const.ERROR_GETTING_LOG_CREDENTIALS)
+    collector.processWorkItem(tracer, ctx, leases, workItemJson)
+
+ctx = None
+tracer = None
@@ -1,127 +1,82 @@
-import datetime
-import threading
-import json
+import logging
 import sys
+import threading
+from typing import List
 
 from ..shared_code import context
 from ..shared_code import tracing
-from ..shared_code import azure, const
-from ..shared_code.providerfactory import *
+from ..shared_code import collector, const
+from ..shared_code.cache import workerCache
+from ..shared_code.lease import LeaseManager
 
 import azure.functions as func
 ###############################################################################
 
-class ProviderInstanceThread(threading.Thread):
-   def __init__(self, providerInstance):
-      threading.Thread.__init__(self)
-      self.providerInstance = providerInstance
-
-   def run(self):
-      global ctx, tracer
-      for check in self.providerInstance.checks:
-         tracer.info("starting check %s" % (check.fullName))
-
-         # Skip this check if it's not enabled or not due yet
-         if (check.isEnabled() == False) or (check.isDue() == False):
-            continue
-
-         # Run all actions that are part of this check
-         resultJson = check.run()
-
-         # Ingest result into Log Analytics
-         ctx.azLa.ingest(check.customLog,
-                         resultJson,
-                         check.colTimeGenerated)
-
-         # Persist updated internal state to provider state file
-         self.providerInstance.writeState()
-
-         # Ingest result into Customer Analytics
-         enableCustomerAnalytics = ctx.globalParams.get("enableCustomerAnalytics", True)
-         if enableCustomerAnalytics and check.includeInCustomerAnalytics:
-             tracing.tracing.ingestCustomerAnalytics(tracer,
-                                             ctx,
-                                             check.customLog,
-                                             resultJson)
-         tracer.info("finished check %s" % (check.fullName))
-      return
-
-###############################################################################
-# Load entire config from KeyVault (global parameters and provider instances)
-def loadConfig() -> bool:
-   global ctx, tracer
-   tracer.info("loading config from KeyVault")
-
-   secrets = ctx.azKv.getCurrentSecrets()
-   for secretName in secrets.keys():
-      tracer.debug("parsing KeyVault secret %s" % secretName)
-      secretValue = secrets[secretName]
-      try:
-         providerProperties = json.loads(secretValue)
-      except json.decoder.JSONDecodeError as e:
-         tracer.error("invalid JSON format for secret %s (%s)" % (secretName,
-                                                                  e))
-         continue
-      if secretName == const.CONFIG_SECTION_GLOBAL:
-         ctx.globalParams = providerProperties
-         tracer.debug("successfully loaded global config")
-      else:
-         instanceName = providerProperties.get("name", None)
-         providerType = providerProperties.get("type", None)
-         try:
-            providerInstance = ProviderFactory.makeProviderInstance(providerType,
-                                                                    tracer,
-                                                                    ctx,
-                                                                    providerProperties,
-                                                                    skipContent = False)
-         except Exception as e:
-            tracer.error("could not validate provider instance %s (%s)" % (instanceName,
-                                                                           e))
-            continue
-         ctx.instances.append(providerInstance)
-         tracer.debug("successfully loaded config for provider instance %s" % instanceName)
-   if ctx.globalParams == {} or len(ctx.instances) == 0:
-      tracer.error("did not find any provider instances in KeyVault")
-      return False
-   return True
-
 # Execute the actual monitoring payload
-def monitor() -> None:
+# In dispatch mode, due provider instances are only enqueued as work items for the queue function
+def monitor(workItems: func.Out[List[str]] = None) -> None:
    global ctx, tracer
    tracer.info("starting monitor payload")
 
-   threads = []
-   if not loadConfig():
+   # Provider instances are kept in the (cached) context until the config TTL expires
+   if not collector.refreshConfig(tracer, ctx):
       tracer.critical("failed to load config from KeyVault")
       sys.exit(const.ERROR_LOADING_CONFIG)
-   logAnalyticsWorkspaceId = ctx.globalParams.get("logAnalyticsWorkspaceId", None)
-   logAnalyticsSharedKey = ctx.globalParams.get("logAnalyticsSharedKey", None)
-   if not logAnalyticsWorkspaceId or not logAnalyticsSharedKey:
-      tracer.critical("global config must contain logAnalyticsWorkspaceId and logAnalyticsSharedKey")
+
+   collectionMode = ctx.globalParams.get("collectionMode", const.COLLECTION_MODE_LOCAL)
+   if collectionMode == const.COLLECTION_MODE_DISPATCH and workItems is not None:
+      leases = workerCache.getOrCreate(const.CACHE_KEY_LEASES,
+                                       lambda: LeaseManager(tracer))
+      workItems.set(collector.makeWorkItems(tracer, ctx, leases))
+      tracer.info("monitor payload successfully dispatched")
+      return
+
+   if not collector.initLogAnalytics(tracer, ctx):
       sys.exit(const.ERROR_GETTING_LOG_CREDENTIALS)
-   ctx.azLa = azure.AzureLogAnalytics(tracer,
-                                logAnalyticsWorkspaceId,
-                                logAnalyticsSharedKey)
-   for i in ctx.instances:
-      thread = ProviderInstanceThread(i)
-      thread.start()
-      threads.append(thread)
 
-   for t in threads:
-      t.join()
+   # Run all due checks through the central scheduler; checks with a frequency below the
+   # timer interval are run repeatedly until the run window has passed
+   scheduler = collector.makeScheduler(tracer,
+                                       ctx,
+                                       windowSecs = ctx.globalParams.get("schedulerWindowSecs", const.SCHEDULER_WINDOW_SECS))
+   scheduler.addInstances(ctx.instances)
+   scheduler.run()
 
    tracer.info("monitor payload successfully completed")
    return
 
-def main(mytimer: func.TimerRequest) -> None:
+def main(mytimer: func.TimerRequest,
+         workItems: func.Out[List[str]]) -> None:
+    # Never let two timer ticks collect at the same time within this worker
+    if not monitorLock.acquire(blocking = False):
+       logging.warning("previous monitor run is still in progress, skipping this timer tick")
+       return
+    try:
+       _main(workItems)
+    finally:
+       monitorLock.release()
+
+def _main(workItems: func.Out[List[str]]) -> None:
     global ctx, tracer
-    tracer = tracing.initTracer()
-    ctx = context.Context(tracer, "monitor")
+    # Tracer and context (incl. KeyVault and storage queue clients) survive across warm invocations
+    tracer = workerCache.getOrCreate(const.CACHE_KEY_TRACER,
+                                     tracing.tracing.initTracer)
+    previousCtx = ctx
+    ctx = workerCache.getOrCreate(const.CACHE_KEY_CONTEXT,
+                                  lambda: context.Context(tracer, "monitor"),
+                                  const.CACHE_TTL_CONTEXT_SECS)
+    # Release the provider instances of an expired context
+    if previousCtx and previousCtx is not ctx and previousCtx.reconciler:
+       previousCtx.reconciler.teardownAll()
     # utc_timestamp = datetime.utcnow().replace(
     #     tzinfo=datetime.timezone.utc).isoformat()
     #
     # if mytimer.past_due:
     #     tracer.info('Persia test The timer is past due!')
 
-    monitor()
+    monitor(workItems)
     tracer.info('Persia\'s Python timer trigger function ran at ')
+
+ctx = None
+tracer = None
+monitorLock = threading.Lock()
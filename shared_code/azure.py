@@ -2,7 +2,7 @@
 from azure.common.credentials import BasicTokenAuthentication
 from azure.mgmt.storage import StorageManagementClient
 from azure.identity import ManagedIdentityCredential
-from azure.keyvault.secrets import SecretClient, KeyVaultSecret
+from azure.keyvault.secrets import SecretClient, KeyVaultSecret, SecretProperties
 
 # Python modules
 import base64
@@ -10,7 +10,7 @@ import hashlib
 import hmac
 import sys
 import os
-from typing import Tuple
+from typing import List, Tuple
 
 # Payload modules
 from .tools import *
@@ -139,6 +139,11 @@ class AzureKeyVault:
          self.tracer.error("could not get current KeyVault secrets (%s)" % e)
       return secrets
 
+   # Get the properties (name, version, last update) of all secrets without fetching their values
+   def getSecretProperties(self) -> List[SecretProperties]:
+      self.tracer.info("getting properties of KeyVault secrets")
+      return list(self.kv_client.list_properties_of_secrets())
+
    # Check if a KeyVault with a specified name exists
    def exists(self) -> bool:
       self.tracer.info("checking if KeyVault %s exists" % self.kvName)
@@ -154,6 +159,131 @@ class AzureKeyVault:
 
 ###############################################################################
 
+# Locally persisted snapshot of the customer KeyVault secrets
+# Only secrets whose version or last update changed since the previous refresh are fetched again
+# The snapshot file only holds the metadata and a hash of each secret; the values are kept in memory
+class AzureKeyVaultSnapshot:
+   azKv = None
+   filename = None
+   secrets = {}
+   secretValues = {}
+   tracer = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                azKv: AzureKeyVault,
+                filename: str = FILENAME_CONFIG_SNAPSHOT):
+      self.tracer = tracer
+      self.azKv = azKv
+      self.filename = filename
+      self.secrets = {}
+      self.secretValues = {}
+      self.readSnapshot()
+
+   # Current values of all secrets in the snapshot
+   def values(self) -> Dict[str, str]:
+      return {name: self.secretValues[name] for name in self.secrets.keys() if name in self.secretValues}
+
+   # Hash a secret value, so a change can be detected without persisting the value itself
+   @staticmethod
+   def hashValue(name: str,
+                 value: str) -> str:
+      return hashlib.sha256(("%s\0%s" % (name, value)).encode("utf-8")).hexdigest()
+
+   # Read the persisted snapshot (if any) from the state directory
+   def readSnapshot(self) -> bool:
+      self.tracer.info("reading KeyVault snapshot")
+      try:
+         with open(self.filename, "r") as file:
+            self.secrets = json.load(file)
+      except FileNotFoundError:
+         self.tracer.info("KeyVault snapshot %s does not exist yet" % self.filename)
+         return False
+      except Exception as e:
+         self.tracer.warning("could not read KeyVault snapshot %s, discarding it (%s)" % (self.filename, e))
+         self.secrets = {}
+         return False
+
+      # Snapshots of earlier versions contained the secret values; replace them by their hash
+      legacy = [name for (name, s) in self.secrets.items() if "value" in s]
+      for name in legacy:
+         s = self.secrets[name]
+         s["hash"] = self.hashValue(name, s.pop("value"))
+      if legacy:
+         self.tracer.info("removing secret values from KeyVault snapshot %s" % self.filename)
+         self.writeSnapshot()
+      return True
+
+   # Persist the snapshot (names, versions, last update and hashes only)
+   def writeSnapshot(self) -> bool:
+      self.tracer.info("writing KeyVault snapshot")
+      try:
+         fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+         with os.fdopen(fd, "w") as file:
+            json.dump(self.secrets, file)
+      except Exception as e:
+         self.tracer.error("could not write KeyVault snapshot %s (%s)" % (self.filename, e))
+         return False
+      return True
+
+   # Refresh the snapshot with a single list call and fetch only added or changed secrets
+   # (after a cold start, all values are fetched once; the persisted hashes tell whether they changed)
+   # Returns a diff with the keys added/changed (name -> value), removed and unchanged (names),
+   # or None if the KeyVault could not be listed
+   def refresh(self) -> Dict[str, object]:
+      self.tracer.info("refreshing KeyVault snapshot")
+      try:
+         properties = self.azKv.getSecretProperties()
+      except Exception as e:
+         self.tracer.error("could not list KeyVault secrets (%s)" % e)
+         return None
+
+      diff = {"added": {}, "changed": {}, "removed": [], "unchanged": []}
+      currentNames = set()
+      snapshotChanged = False
+      for p in properties:
+         currentNames.add(p.name)
+         updatedOn = p.updated_on.isoformat() if p.updated_on else None
+         previous = self.secrets.get(p.name, None)
+         if previous and previous["version"] == p.version and previous["updatedOn"] == updatedOn \
+            and p.name in self.secretValues:
+            diff["unchanged"].append(p.name)
+            continue
+         secret = self.azKv.getSecret(p.name)
+         if not secret:
+            # Keep the previous value (if any) and try again with the next refresh
+            if previous and p.name in self.secretValues:
+               diff["unchanged"].append(p.name)
+            continue
+         valueHash = self.hashValue(p.name, secret.value)
+         self.secretValues[p.name] = secret.value
+         metadata = {
+            "version": p.version,
+            "updatedOn": updatedOn,
+            "hash": valueHash
+         }
+         if metadata != previous:
+            self.secrets[p.name] = metadata
+            snapshotChanged = True
+         if previous and previous.get("hash", None) == valueHash:
+            diff["unchanged"].append(p.name)
+         else:
+            diff["changed" if previous else "added"][p.name] = secret.value
+      for name in list(self.secrets.keys()):
+         if name not in currentNames:
+            del self.secrets[name]
+            self.secretValues.pop(name, None)
+            diff["removed"].append(name)
+            snapshotChanged = True
+
+      self.tracer.info("KeyVault snapshot refreshed (added=%d, changed=%d, removed=%d, unchanged=%d)" % \
+         (len(diff["added"]), len(diff["changed"]), len(diff["removed"]), len(diff["unchanged"])))
+      if snapshotChanged:
+         self.writeSnapshot()
+      return diff
+
+###############################################################################
+
 # Provide access to an Azure Log Analytics Workspace
 class AzureLogAnalytics:
    sharedKey = None
@@ -1,12 +1,14 @@
 # Python modules
 from abc import ABC, abstractmethod
 from datetime import timedelta
-from retry.api import retry_call
-from typing import List
+import threading
+import time
+from typing import Iterator, List
 
 # Payload modules
 from .context import *
 from .tools import *
+from .circuitbreaker import CircuitBreaker, EndpointUnreachableError
 
 ###############################################################################
 
@@ -22,6 +24,9 @@ class ProviderInstance(ABC):
    checks = []
    state = {}
    retrySettings = {}
+   circuitBreaker = None
+   deferStateWrites = False
+   stateWriteDeferred = False
    
    def __init__(self,
                 tracer: logging.Logger,
@@ -38,7 +43,9 @@ class ProviderInstance(ABC):
       self.providerType = providerInstance["type"]
       self.fullName = "%s/%s" % (self.providerType, self.name)
       self.state = {}
+      self.stateLock = threading.RLock()
       self.retrySettings = retrySettings
+      self.circuitBreaker = None
       if not self.parseProperties():
          raise ValueError("failed to parse properties of the provider instance")
       if not skipContent and not self.initContent():
@@ -55,7 +62,7 @@ class ProviderInstance(ABC):
          self.tracer.debug("filename=%s" % filename)
          with open(filename, "r") as file:
             data = file.read()
-         jsonData = json.loads(data, object_hook=JsonDecoder.datetimeHook)
+         jsonData = JsonBackend.loads(data, objectHook=JsonDecoder.datetimeHook)
       except FileNotFoundError as e:
          self.tracer.warning("[%s] content file %s does not exist" % (self.fullName,
                                                                       filename))
@@ -83,10 +90,45 @@ class ProviderInstance(ABC):
             self.tracer.error("[%s] could not instantiate check for provider type %s (%s)" % (self.fullName,
                                                                                               self.providerType,
                                                                                               e))
+      self._validateCheckDependencies()
       return True
 
+   # Make sure the dependencies between checks refer to existing checks and do not form a cycle
+   def _validateCheckDependencies(self) -> None:
+      checksByName = {c.name: c for c in self.checks}
+      for check in self.checks:
+         unknown = [d for d in check.dependsOn if d not in checksByName]
+         if unknown:
+            self.tracer.warning("[%s] ignoring unknown dependencies %s" % (check.fullName,
+                                                                          unknown))
+            check.dependsOn = [d for d in check.dependsOn if d in checksByName]
+
+      # Depth-first search; a check whose dependencies close a cycle loses its dependencies
+      (visiting, done) = (set(), set())
+      def visit(check: ProviderCheck) -> bool:
+         if check.name in done:
+            return True
+         if check.name in visiting:
+            return False
+         visiting.add(check.name)
+         acyclic = all([visit(checksByName[d]) for d in check.dependsOn])
+         visiting.discard(check.name)
+         if not acyclic:
+            self.tracer.error("[%s] check dependencies %s form a cycle, ignoring them" % (check.fullName,
+                                                                                         check.dependsOn))
+            check.dependsOn = []
+         done.add(check.name)
+         return True
+      for check in self.checks:
+         visit(check)
+      return
+
    # Read most recent, provider-specific state from state file
    def readState(self) -> bool:
+      with self.stateLock:
+         return self._readState()
+
+   def _readState(self) -> bool:
       self.tracer.info("[%s] reading state file for provider instance" % self.fullName)
       jsonData = {}
 
@@ -97,7 +139,7 @@ class ProviderInstance(ABC):
                                                  filename))
          with open(filename, "r") as file:
             data = file.read()
-         jsonData = json.loads(data, object_hook=JsonDecoder.datetimeHook)
+         jsonData = JsonBackend.loads(data, objectHook=JsonDecoder.datetimeHook)
       except FileNotFoundError as e:
          self.tracer.warning("[%s] state file %s does not exist" % (self.fullName,
                                                                     filename))
@@ -126,7 +168,16 @@ class ProviderInstance(ABC):
       return True
 
    # Write current state for this provider and its checks into state file
+   # (checks of the same instance may run in parallel, so the state file is written under a lock)
+   # Inside a worker process the write is only recorded, as the parent merges and writes the state
    def writeState(self) -> bool:
+      with self.stateLock:
+         if self.deferStateWrites:
+            self.stateWriteDeferred = True
+            return True
+         return self._writeState()
+
+   def _writeState(self) -> bool:
       self.tracer.info("[%s] writing state file for provider instance" % self.fullName)
 
       # Initialize JSON object with global state
@@ -140,13 +191,13 @@ class ProviderInstance(ABC):
          checkStates[check.name] = check.state
       jsonData["checks"] = checkStates
 
-      # Write JSON object into state file
+      # Write JSON object into state file (compact, as it is written after every check)
       try:
          filename = os.path.join(PATH_STATE, "%s.state" % self.name)
          self.tracer.debug("[%s] filename=%s" % (self.fullName,
                                                  filename))
          with open(filename, "w") as file:
-            json.dump(jsonData, file, indent=3, cls=JsonEncoder)
+            file.write(JsonBackend.dumps(jsonData, separators=(",", ":")))
       except Exception as e:
          self.tracer.error("[%s] could not write state file %s (%s)" % (self.fullName,
                                                                         filename,
@@ -156,6 +207,33 @@ class ProviderInstance(ABC):
       self.tracer.info("[%s] successfully wrote state file for provider instance" % self.fullName)
       return True
 
+   # Create the circuit breaker shared by all checks that connect to the endpoint of this instance
+   # probe is a cheap reachability check that is used while the breaker is open
+   def initCircuitBreaker(self,
+                          endpoint: str,
+                          probe: Callable[[], bool]) -> None:
+      self.circuitBreaker = CircuitBreaker(self.tracer,
+                                           self,
+                                           endpoint,
+                                           probe,
+                                           self.providerProperties.get("circuitBreakerFailureThreshold", CIRCUIT_BREAKER_FAILURE_THRESHOLD),
+                                           self.providerProperties.get("circuitBreakerOpenSecs", CIRCUIT_BREAKER_OPEN_SECS),
+                                           self.providerProperties.get("circuitBreakerTrialTimeoutSecs", CIRCUIT_BREAKER_TRIAL_TIMEOUT_SECS))
+      return
+
+   # Replace the locks of this instance inside a forked worker process
+   # (another thread of the parent may have held them at the time of the fork)
+   def reinitAfterFork(self) -> None:
+      self.stateLock = threading.RLock()
+      if self.circuitBreaker:
+         self.circuitBreaker.reinitAfterFork()
+      return
+
+   # Release resources held by this instance (e.g. when its config has been changed or removed)
+   def close(self) -> None:
+      self.tracer.info("[%s] closing provider instance" % self.fullName)
+      return
+
    # Provider-specific validation logic (e.g. establish HANA connection)
    @abstractmethod
    def validate(self) -> bool:
@@ -177,6 +255,17 @@ class ProviderCheck(ABC):
    frequencySecs = None
    includeInCustomerAnalytics = False
    actions = []
+   dependsOn = []
+   timeoutSecs = None
+   ingestOnChangeOnly = False
+   maxHeartbeatSecs = None
+   resultChanged = True
+   catchingUp = False
+   deadline = None
+   cancelled = False
+   runState = None
+   queued = False
+   unreachableEndpoint = None
    state = {}
    fullName = None
    tracer = None
@@ -190,7 +279,11 @@ class ProviderCheck(ABC):
                 frequencySecs: int,
                 actions: List[str],
                 includeInCustomerAnalytics: bool = False,
-                enabled: bool = True):
+                enabled: bool = True,
+                dependsOn: List[str] = None,
+                timeoutSecs: int = CHECK_TIMEOUT_SECS,
+                ingestOnChangeOnly: bool = False,
+                maxHeartbeatSecs: int = CHECK_MAX_HEARTBEAT_SECS):
       self.providerInstance = providerInstance
       self.name = name
       self.description = description
@@ -198,12 +291,27 @@ class ProviderCheck(ABC):
       self.frequencySecs = frequencySecs
       self.includeInCustomerAnalytics = includeInCustomerAnalytics
       self.actions = actions
+      self.dependsOn = dependsOn if dependsOn else []
+      self.timeoutSecs = timeoutSecs
+      self.ingestOnChangeOnly = ingestOnChangeOnly
+      self.maxHeartbeatSecs = maxHeartbeatSecs
+      self.resultChanged = True
+      self.catchingUp = False
+      self.deadline = None
+      self.cancelled = False
+      # Set by the scheduler while the check is waiting to be run (queued or deferred)
+      self.queued = False
+      self.runState = None
+      self.unreachableEndpoint = None
       self.state = {
          "isEnabled": enabled,
          "lastRunLocal": None
       }
       self.fullName = "%s.%s" % (self.providerInstance.fullName, self.name)
       self.tracer = providerInstance.tracer
+      if self.ingestOnChangeOnly and self.maxHeartbeatSecs <= self.frequencySecs:
+         self.tracer.warning("[%s] maxHeartbeatSecs (%d) does not exceed frequencySecs (%d), every result will be ingested" % \
+            (self.fullName, self.maxHeartbeatSecs, self.frequencySecs))
 
    # Return if this check is enabled or not
    def isEnabled(self) -> bool:
@@ -218,6 +326,8 @@ class ProviderCheck(ABC):
       # lastRunLocal = last execution time on collector VM
       # lastRunServer (used in provider) = last execution time on (HANA) server
       self.tracer.debug("[%s] verifying if check is due to be run" % self.fullName)
+      if self.catchingUp:
+         return True
       lastRunLocal = self.state.get("lastRunLocal", None)
       self.tracer.debug("[%s] lastRunLocal=%s; frequencySecs=%d; currentLocal=%s" % (self.fullName,
                                                                                      lastRunLocal,
@@ -229,36 +339,179 @@ class ProviderCheck(ABC):
          return False
       return True
 
+   # Determine how many seconds are left until this check is due (0 if it is due already)
+   # A check that is catching up on a backlog (set by the last execution) is due right away
+   def secondsUntilDue(self) -> float:
+      lastRunLocal = self.state.get("lastRunLocal", None)
+      if not lastRunLocal or self.catchingUp:
+         return 0
+      nextRunLocal = lastRunLocal + timedelta(seconds = self.frequencySecs)
+      return max(0, (nextRunLocal - datetime.utcnow()).total_seconds())
+
+   # Seconds left until the deadline of the current execution (None if there is no deadline)
+   def remainingSecs(self) -> float:
+      if self.deadline is None:
+         return None
+      return max(0, self.deadline - time.monotonic())
+
+   # Limit a timeout (e.g. of a connection attempt) to the time left until the deadline
+   def boundedTimeout(self,
+                      timeoutSecs: int) -> int:
+      remaining = self.remainingSecs()
+      if remaining is None:
+         return timeoutSecs
+      return max(1, min(timeoutSecs, int(remaining)))
+
    # Method that gets called when this check is executed
    # Returns a JSON-formatted string that can be ingested into Log Analytics
+   # (waits for retries on the calling thread; the scheduler uses startRun/resume instead)
    def run(self) -> str:
+      self.startRun()
+      while True:
+         retryDelay = self.resume()
+         if retryDelay is None:
+            break
+         time.sleep(retryDelay)
+      return self.generateResultJsonString()
+
+   # Prepare a new execution of all actions of this check
+   def startRun(self) -> None:
       self.tracer.info("[%s] executing all actions of check" % self.fullName)
       self.tracer.debug("[%s] actions=%s" % (self.fullName,
                                              self.actions))
-      for action in self.actions:
+      self.cancelled = False
+      self.unreachableEndpoint = None
+      self.resultChanged = True
+      self.catchingUp = False
+      self.runState = {
+         "actionIndex": 0,
+         "attempt": 0,
+         "delay": None
+      }
+      return
+
+   # Return if an execution has been started but not all actions have been run yet
+   def isInProgress(self) -> bool:
+      return self.runState is not None
+
+   # Give up on an execution that is waiting for a retry
+   def abortRun(self) -> None:
+      if self.runState is None:
+         return
+      self.tracer.warning("[%s] cancelling pending retry and all remaining actions" % self.fullName)
+      self.cancelled = True
+      self.runState = None
+      return
+
+   # Run the remaining actions of the current execution; a failed action is not retried in here,
+   # instead the delay until its next attempt is returned so the caller can run other work meanwhile
+   # Retries (and pending actions) are cancelled once the deadline of this check has passed or
+   # would pass while waiting for the next attempt
+   # Returns None once the execution is finished
+   def resume(self) -> float:
+      while self.runState["actionIndex"] < len(self.actions):
+         action = self.actions[self.runState["actionIndex"]]
          methodName = METHODNAME_ACTION % action["type"]
          parameters = action.get("parameters", {})
+         tries = action.get("retries", self.providerInstance.retrySettings["retries"])
+         backoff = action.get("backoffMultiplier", self.providerInstance.retrySettings["backoffMultiplier"])
+         if self.runState["delay"] is None:
+            self.runState["delay"] = action.get("delayInSeconds", self.providerInstance.retrySettings["delayInSeconds"])
+         if self.deadline is not None and self.remainingSecs() <= 0:
+            self.tracer.warning("[%s] deadline exceeded, cancelling action %s and all remaining actions" % (self.fullName,
+                                                                                                            methodName))
+            self.cancelled = True
+            break
          self.tracer.debug("[%s] calling action %s" % (self.fullName,
                                                        methodName))
          method = getattr(self, methodName)
-         tries = action.get("retries", self.providerInstance.retrySettings["retries"])
-         delay = action.get("delayInSeconds", self.providerInstance.retrySettings["delayInSeconds"])
-         backoff = action.get("backoffMultiplier", self.providerInstance.retrySettings["backoffMultiplier"])
-
-         try :
-            retry_call(method, fkwargs=parameters, tries=tries, delay=delay, backoff=backoff, logger=self.tracer)
-         except Exception as e:
-            self.tracer.error("[%s] error executing action %s, Exception %s, skipping remaining actions" % (self.fullName,
-                                                                                                            methodName,
-                                                                                                            e))
+         try:
+            method(**parameters)
+         except EndpointUnreachableError as e:
+            # Neither retry nor run further actions against an endpoint that is known to be down
+            self.tracer.warning("[%s] %s, skipping remaining actions" % (self.fullName,
+                                                                        e))
+            self.unreachableEndpoint = e.endpoint
             break
+         except Exception as e:
+            self.runState["attempt"] += 1
+            if tries >= 0 and self.runState["attempt"] >= tries:
+               self.tracer.error("[%s] error executing action %s, Exception %s, skipping remaining actions" % (self.fullName,
+                                                                                                               methodName,
+                                                                                                               e))
+               break
+            delay = self.runState["delay"]
+            remaining = self.remainingSecs()
+            if remaining is not None and remaining <= delay:
+               self.tracer.warning("[%s] error executing action %s (%s), not enough time left to retry, cancelling remaining actions" % \
+                  (self.fullName, methodName, e))
+               self.cancelled = True
+               break
+            self.tracer.warning("[%s] %s, retrying in %s seconds..." % (self.fullName,
+                                                                       e,
+                                                                       delay))
+            self.runState["delay"] = delay * backoff
+            return delay
+         self.runState = {
+            "actionIndex": self.runState["actionIndex"] + 1,
+            "attempt": 0,
+            "delay": None
+         }
+      self.runState = None
+      return None
+
+   # Generate the JSON string to be ingested for the current execution
+   # (an "unreachable" record instead of the result, if the endpoint could not be reached)
+   def generateResultJsonString(self) -> str:
+      if self.unreachableEndpoint:
+         return self.generateUnreachableJsonString()
       return self.generateJsonString()
 
+   # Determine if the result of the current execution has to be ingested
+   # Checks that only ingest on change skip an unchanged result, unless the last ingestion
+   # is older than maxHeartbeatSecs (subclasses that can tell set resultChanged in updateState)
+   def shouldIngest(self) -> bool:
+      if not self.ingestOnChangeOnly or self.unreachableEndpoint or self.resultChanged:
+         return True
+      lastIngestLocal = self.state.get("lastIngestLocal", None)
+      if not lastIngestLocal or \
+         lastIngestLocal + timedelta(seconds = self.maxHeartbeatSecs) <= datetime.utcnow():
+         self.tracer.info("[%s] result has not changed, ingesting it as heartbeat" % self.fullName)
+         return True
+      self.tracer.info("[%s] result has not changed since last ingestion at %s, skipping ingestion" % (self.fullName,
+                                                                                                       lastIngestLocal))
+      return False
+
+   # Generate the JSON strings to be ingested for the current execution, one chunk at a time
+   # (checks that stream their result hand it over in several chunks)
+   def generateResultJsonChunks(self) -> Iterator[str]:
+      if self.unreachableEndpoint:
+         yield self.generateUnreachableJsonString()
+         return
+      yield from self.generateJsonChunks()
+
+   # Generate a JSON-encoded string with a single record stating that the endpoint is unreachable
+   def generateUnreachableJsonString(self) -> str:
+      logItem = {
+         "SAPMON_VERSION": PAYLOAD_VERSION,
+         "PROVIDER_INSTANCE": self.providerInstance.name,
+         "METADATA": self.providerInstance.metadata,
+         "ENDPOINT": self.unreachableEndpoint,
+         "STATUS": "unreachable"
+      }
+      if self.colTimeGenerated:
+         logItem[self.colTimeGenerated] = datetime.utcnow()
+      return JsonBackend.dumps([logItem], sortKeys = True, separators = (",", ":"))
+
    # Method to generate a JSON object that can be ingested into Log Analytics
    @abstractmethod
    def generateJsonString(self) -> str:
       return
 
+   # Method to generate the JSON objects to be ingested in chunks (by default, a single chunk)
+   def generateJsonChunks(self) -> Iterator[str]:
+      yield self.generateJsonString()
+
    # Method that gets called when the internal state is updated
    @abstractmethod
    def updateState(self):
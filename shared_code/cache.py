@@ -0,0 +1,57 @@
+# Python modules
+import threading
+import time
+from typing import Callable, Optional
+
+###############################################################################
+
+# Process-level cache for objects that should survive across invocations
+# of a warm Functions worker (context, clients, provider instances)
+class WorkerCache(object):
+   def __init__(self):
+      self._entries = {}
+      self._lock = threading.RLock()
+
+   # Return a cached value, or None if it does not exist or has expired
+   def get(self,
+           key: str) -> object:
+      with self._lock:
+         entry = self._entries.get(key, None)
+         if not entry:
+            return None
+         (value, expiresAt) = entry
+         if expiresAt is not None and expiresAt <= time.monotonic():
+            del self._entries[key]
+            return None
+         return value
+
+   # Store a value; ttlSecs=None keeps it for the lifetime of the process
+   def set(self,
+           key: str,
+           value: object,
+           ttlSecs: Optional[int] = None) -> None:
+      with self._lock:
+         expiresAt = time.monotonic() + ttlSecs if ttlSecs is not None else None
+         self._entries[key] = (value, expiresAt)
+
+   # Return a cached value or create (and cache) it via the factory
+   # A factory result of None is not cached, so failures are retried next time
+   def getOrCreate(self,
+                   key: str,
+                   factory: Callable[[], object],
+                   ttlSecs: Optional[int] = None) -> object:
+      with self._lock:
+         value = self.get(key)
+         if value is None:
+            value = factory()
+            if value is not None:
+               self.set(key, value, ttlSecs)
+         return value
+
+   # Check if a non-expired entry exists for a key
+   def isFresh(self,
+               key: str) -> bool:
+      return self.get(key) is not None
+
+# Singleton cache instance shared by all invocations within this worker process
+workerCache = WorkerCache()
@@ -0,0 +1,182 @@
+# Python modules
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+from typing import Callable, Dict
+
+###############################################################################
+
+CIRCUIT_CLOSED    = "closed"
+CIRCUIT_OPEN      = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+# Raised by a check instead of connecting to an endpoint that is known to be unreachable
+class EndpointUnreachableError(Exception):
+   def __init__(self,
+                endpoint: str,
+                message: str = None):
+      self.endpoint = endpoint
+      super().__init__(message if message else "endpoint %s is unreachable" % endpoint)
+
+###############################################################################
+
+# Circuit breaker for an endpoint of a provider instance (shared by all checks of the instance)
+# - closed: requests go through; consecutive failures are counted
+# - open: requests are rejected; once the open period has passed, a cheap probe is sent
+# - half-open: the probe succeeded, a single trial request decides whether to close or re-open
+#   (a trial that never reports back is ended by its caller, or expires after trialTimeoutSecs)
+# The breaker state is kept in the provider state, so it survives across runs
+class CircuitBreaker(object):
+   tracer = None
+   providerInstance = None
+   endpoint = None
+   probe = None
+   failureThreshold = None
+   openSecs = None
+   trialTimeoutSecs = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                providerInstance: object,
+                endpoint: str,
+                probe: Callable[[], bool],
+                failureThreshold: int,
+                openSecs: int,
+                trialTimeoutSecs: int):
+      self.tracer = tracer
+      self.providerInstance = providerInstance
+      self.endpoint = endpoint
+      self.probe = probe
+      self.failureThreshold = max(1, failureThreshold)
+      self.openSecs = openSecs
+      self.trialTimeoutSecs = trialTimeoutSecs
+      self._probing = False
+      # (thread, start time) of the pending trial request of a half-open breaker
+      self._trial = None
+      self._lock = threading.Lock()
+
+   # Replace the lock (and trial flag) inherited by a forked worker process
+   def reinitAfterFork(self) -> None:
+      self._lock = threading.Lock()
+      self._probing = False
+      self._trial = None
+      return
+
+   # Breaker state of this endpoint inside the provider state
+   # (the provider state gets replaced when it is read from the state file, so never hold on to it)
+   def _state(self) -> Dict[str, object]:
+      breakers = self.providerInstance.state.setdefault("circuitBreakers", {})
+      if self.endpoint not in breakers:
+         breakers[self.endpoint] = {
+            "state": CIRCUIT_CLOSED,
+            "failures": 0,
+            "openedAt": None,
+            "nextProbeAt": None
+         }
+      return breakers[self.endpoint]
+
+   # Return the current state of the breaker (closed, open or half-open)
+   def getState(self) -> str:
+      with self.providerInstance.stateLock:
+         return self._state()["state"]
+
+   # Determine if a request to the endpoint may be sent right now
+   def allowRequest(self) -> bool:
+      with self.providerInstance.stateLock:
+         state = self._state()
+         if state["state"] == CIRCUIT_CLOSED:
+            return True
+         if state["state"] == CIRCUIT_HALF_OPEN:
+            # Only a single trial request at a time
+            with self._lock:
+               if self._trial and time.monotonic() - self._trial[1] < self.trialTimeoutSecs:
+                  return False
+               if self._trial:
+                  self.tracer.warning("[%s] trial request to %s did not report back, allowing another one" % \
+                     (self.providerInstance.fullName, self.endpoint))
+               self._startTrial()
+               return True
+         nextProbeAt = state.get("nextProbeAt", None)
+         if isinstance(nextProbeAt, datetime) and nextProbeAt > datetime.utcnow():
+            return False
+      with self._lock:
+         if self._probing:
+            return False
+         self._probing = True
+
+      # Probe outside of the state lock, so other checks are not held up by an unresponsive endpoint
+      self.tracer.info("[%s] circuit breaker for %s is open, probing endpoint" % (self.providerInstance.fullName,
+                                                                                 self.endpoint))
+      try:
+         reachable = self.probe()
+      except Exception as e:
+         self.tracer.warning("[%s] could not probe %s (%s)" % (self.providerInstance.fullName,
+                                                               self.endpoint,
+                                                               e))
+         reachable = False
+      with self.providerInstance.stateLock:
+         state = self._state()
+         with self._lock:
+            self._probing = False
+            if not reachable:
+               state["nextProbeAt"] = datetime.utcnow() + timedelta(seconds = self.openSecs)
+               self.tracer.warning("[%s] %s is still unreachable" % (self.providerInstance.fullName,
+                                                                     self.endpoint))
+               return False
+            self.tracer.info("[%s] %s responded to probe, circuit breaker is half-open" % (self.providerInstance.fullName,
+                                                                                          self.endpoint))
+            state["state"] = CIRCUIT_HALF_OPEN
+            self._startTrial()
+            return True
+
+   # Record a successful request; closes the breaker
+   def recordSuccess(self) -> None:
+      with self.providerInstance.stateLock:
+         state = self._state()
+         if state["state"] != CIRCUIT_CLOSED:
+            self.tracer.info("[%s] %s is reachable again, closing circuit breaker" % (self.providerInstance.fullName,
+                                                                                     self.endpoint))
+         state.update({
+            "state": CIRCUIT_CLOSED,
+            "failures": 0,
+            "openedAt": None,
+            "nextProbeAt": None
+         })
+         with self._lock:
+            self._trial = None
+      return
+
+   # Record a failed request; opens the breaker once the failure threshold is reached
+   # (or immediately, if the trial request of a half-open breaker failed)
+   def recordFailure(self) -> None:
+      with self.providerInstance.stateLock:
+         state = self._state()
+         state["failures"] = state.get("failures", 0) + 1
+         if state["state"] == CIRCUIT_HALF_OPEN or state["failures"] >= self.failureThreshold:
+            if state["state"] != CIRCUIT_OPEN:
+               self.tracer.warning("[%s] %s failed %d time(s), opening circuit breaker for %d seconds" % \
+                  (self.providerInstance.fullName, self.endpoint, state["failures"], self.openSecs))
+            now = datetime.utcnow()
+            state.update({
+               "state": CIRCUIT_OPEN,
+               "openedAt": now,
+               "nextProbeAt": now + timedelta(seconds = self.openSecs)
+            })
+         with self._lock:
+            self._trial = None
+      return
+
+   # End the trial request started by the calling thread without recording its outcome
+   # (to be called once the caller is done, e.g. in a finally block); the breaker stays half-open,
+   # so the next request becomes the trial
+   def endTrial(self) -> None:
+      with self._lock:
+         if self._trial and self._trial[0] == threading.get_ident():
+            self._trial = None
+      return
+
+   # Mark the calling thread as the one sending the trial request (to be called with the lock held)
+   def _startTrial(self) -> None:
+      self._trial = (threading.get_ident(), time.monotonic())
+      return
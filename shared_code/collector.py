@@ -0,0 +1,245 @@
+# Python modules
+from datetime import datetime
+import hashlib
+import json
+import logging
+from typing import Dict, List, Optional
+
+# Payload modules
+from .const import *
+from .context import Context
+from .base import ProviderCheck
+from .azure import AzureLogAnalytics
+from .cache import workerCache
+from .lease import LeaseManager
+from .reconciler import ProviderInstanceReconciler
+from .scheduler import CheckScheduler
+from .tools import JsonEncoder
+from .tracing import tracing
+from .workerpool import WorkerPool
+
+###############################################################################
+
+# Run a single check and ingest its result (dispatched by the check scheduler)
+# Returns the delay until the check has to be resumed if one of its actions is waiting for a retry
+def runCheck(check: ProviderCheck) -> Optional[float]:
+   ctx = check.providerInstance.ctx
+   tracer = check.tracer
+   if not check.isInProgress():
+      tracer.info("starting check %s" % (check.fullName))
+      check.startRun()
+
+   # Run all (remaining) actions that are part of this check
+   retryDelay = check.resume()
+   if retryDelay is not None:
+      return retryDelay
+
+   # A cancelled execution has no (new) result, so neither ingest the previous one again nor
+   # persist any state of it
+   if check.cancelled:
+      tracer.warning("cancelled check %s, skipping ingestion" % (check.fullName))
+      return None
+
+   # Ingest result into Log Analytics and Customer Analytics
+   # (chunk by chunk, so a streamed result is never held in memory entirely)
+   if check.shouldIngest():
+      enableCustomerAnalytics = ctx.globalParams.get("enableCustomerAnalytics", True)
+      for resultJson in check.generateResultJsonChunks():
+         ctx.azLa.ingest(check.customLog,
+                         resultJson,
+                         check.colTimeGenerated)
+         if enableCustomerAnalytics and check.includeInCustomerAnalytics:
+            tracing.ingestCustomerAnalytics(tracer,
+                                            ctx,
+                                            check.customLog,
+                                            resultJson)
+      check.state["lastIngestLocal"] = datetime.utcnow()
+
+   # Persist updated internal state to provider state file
+   check.providerInstance.writeState()
+   tracer.info("finished check %s" % (check.fullName))
+   return None
+
+###############################################################################
+
+# Load entire config from KeyVault (global parameters and provider instances)
+# configDiff is the result of the latest KeyVault snapshot refresh
+def loadConfig(tracer: logging.Logger,
+               ctx: Context,
+               configDiff: Dict[str, object]) -> bool:
+   tracer.info("loading config from KeyVault")
+
+   if configDiff is None:
+      if len(ctx.instances) > 0:
+         tracer.warning("could not refresh config from KeyVault, keeping %d provider instances" % len(ctx.instances))
+         return True
+      return False
+   if not ctx.reconciler:
+      ctx.reconciler = ProviderInstanceReconciler(tracer, ctx)
+   if not configDiff["added"] and not configDiff["changed"] and not configDiff["removed"] \
+      and len(ctx.instances) > 0 and not ctx.reconciler.failed:
+      tracer.info("config has not changed, keeping %d provider instances" % len(ctx.instances))
+      return True
+
+   instanceConfigs = {}
+   secrets = ctx.configSnapshot.values()
+   for secretName in secrets.keys():
+      tracer.debug("parsing KeyVault secret %s" % secretName)
+      secretValue = secrets[secretName]
+      try:
+         providerProperties = json.loads(secretValue)
+      except json.decoder.JSONDecodeError as e:
+         tracer.error("invalid JSON format for secret %s (%s)" % (secretName,
+                                                                  e))
+         continue
+      if secretName == CONFIG_SECTION_GLOBAL:
+         ctx.globalParams = providerProperties
+         tracer.debug("successfully loaded global config")
+      else:
+         instanceName = providerProperties.get("name", None)
+         if not instanceName:
+            tracer.error("provider instance in secret %s has no name, skipping it" % secretName)
+            continue
+         if instanceName in instanceConfigs:
+            tracer.error("provider instance %s is defined more than once, skipping secret %s" % (instanceName,
+                                                                                                 secretName))
+            continue
+         instanceConfigs[instanceName] = providerProperties
+
+   # Only create, replace or tear down the provider instances whose config has changed
+   ctx.instances = ctx.reconciler.reconcile(instanceConfigs)
+   if ctx.globalParams == {} or len(ctx.instances) == 0:
+      tracer.error("did not find any provider instances in KeyVault")
+      return False
+   return True
+
+# Reload the config if the cached one has expired (Functions workers keep it across invocations)
+# Timer and queue invocations of a worker share the context, so only one of them reloads it at a time
+def refreshConfig(tracer: logging.Logger,
+                  ctx: Context) -> bool:
+   with ctx.configLock:
+      if workerCache.isFresh(CACHE_KEY_CONFIG) and len(ctx.instances) > 0:
+         tracer.info("reusing cached config with %d provider instances" % len(ctx.instances))
+         return True
+      if not loadConfig(tracer, ctx, ctx.configSnapshot.refresh()):
+         return False
+      workerCache.set(CACHE_KEY_CONFIG,
+                      True,
+                      ctx.globalParams.get("configCacheTtlSecs", CACHE_TTL_CONFIG_SECS))
+      return True
+
+# Make sure the context has a Log Analytics client for the configured workspace
+# (only re-created if the workspace credentials have changed)
+def initLogAnalytics(tracer: logging.Logger,
+                     ctx: Context) -> bool:
+   logAnalyticsWorkspaceId = ctx.globalParams.get("logAnalyticsWorkspaceId", None)
+   logAnalyticsSharedKey = ctx.globalParams.get("logAnalyticsSharedKey", None)
+   if not logAnalyticsWorkspaceId or not logAnalyticsSharedKey:
+      tracer.critical("global config must contain logAnalyticsWorkspaceId and logAnalyticsSharedKey")
+      return False
+   if not ctx.azLa or \
+      ctx.azLa.workspaceId != logAnalyticsWorkspaceId or \
+      ctx.azLa.sharedKey != logAnalyticsSharedKey:
+      ctx.azLa = AzureLogAnalytics(tracer,
+                                   logAnalyticsWorkspaceId,
+                                   logAnalyticsSharedKey)
+   return True
+
+# Create a check scheduler (and its worker pool) with the settings from the global config
+def makeScheduler(tracer: logging.Logger,
+                  ctx: Context,
+                  windowSecs: int) -> CheckScheduler:
+   workerPool = WorkerPool(tracer,
+                           maxWorkers = ctx.globalParams.get("schedulerMaxWorkers", SCHEDULER_MAX_WORKERS),
+                           providerTypeLimits = ctx.globalParams.get("providerTypeConcurrency", PROVIDER_TYPE_CONCURRENCY),
+                           poolType = ctx.globalParams.get("workerPoolType", WORKER_POOL_TYPE))
+   return CheckScheduler(tracer,
+                         runCheck,
+                         workerPool,
+                         windowSecs = windowSecs,
+                         maxChecksPerInstance = ctx.globalParams.get("maxParallelChecksPerInstance", MAX_PARALLEL_CHECKS_PER_INSTANCE),
+                         deadlineSecs = ctx.globalParams.get("runDeadlineSecs", RUN_DEADLINE_SECS))
+
+###############################################################################
+
+# Build one work item (JSON string) for each provider instance that has due checks
+# Instances that are being collected right now (i.e. leased by a worker) are left for the next dispatch
+# The idempotency key is derived from the instance, the dispatch period and the last run of its due
+# checks, so the same work item dispatched twice (or delivered twice by the queue) is only collected
+# once, while checks that failed (and did not advance their last run) are dispatched again next period
+def makeWorkItems(tracer: logging.Logger,
+                  ctx: Context,
+                  leases: LeaseManager) -> List[str]:
+   workItems = []
+   dispatchedAt = datetime.utcnow()
+   dispatchPeriodSecs = ctx.globalParams.get("dispatchPeriodSecs", DISPATCH_PERIOD_SECS)
+   dispatchTick = int(dispatchedAt.timestamp() // dispatchPeriodSecs)
+   for providerInstance in ctx.instances:
+      if not leases.acquire(providerInstance.name, ctx.globalParams.get("workItemLeaseSecs", WORK_ITEM_LEASE_SECS)):
+         tracer.info("[%s] provider instance is being collected, not dispatching it" % providerInstance.fullName)
+         continue
+      try:
+         # Pick up the state written by the workers since the last dispatch
+         providerInstance.readState()
+         dueChecks = [c for c in providerInstance.checks if c.isEnabled() and c.isDue()]
+      finally:
+         leases.release(providerInstance.name)
+      if not dueChecks:
+         continue
+      checkRuns = [(c.name, c.state.get("lastRunLocal", None)) for c in dueChecks]
+      key = hashlib.md5(json.dumps([providerInstance.name, dispatchTick, checkRuns], cls=JsonEncoder).encode("utf-8")).hexdigest()
+      workItems.append(json.dumps({
+         "instance": providerInstance.name,
+         "checks": [c.name for c in dueChecks],
+         "key": key,
+         "dispatchedAt": dispatchedAt
+      }, cls=JsonEncoder))
+   tracer.info("dispatching %d work items for %d provider instances" % (len(workItems),
+                                                                       len(ctx.instances)))
+   return workItems
+
+# Collect the provider instance of a work item (unless another worker holds its lease or
+# the work item has been processed already)
+# Returns if the work item has been processed by this call
+def processWorkItem(tracer: logging.Logger,
+                    ctx: Context,
+                    leases: LeaseManager,
+                    workItemJson: str) -> bool:
+   try:
+      workItem = json.loads(workItemJson)
+      instanceName = workItem["instance"]
+      key = workItem["key"]
+   except Exception as e:
+      tracer.error("invalid work item %s (%s)" % (workItemJson, e))
+      return False
+   providerInstance = next((i for i in ctx.instances if i.name == instanceName), None)
+   if not providerInstance:
+      tracer.warning("provider instance %s of work item %s does not exist (anymore)" % (instanceName,
+                                                                                       key))
+      return False
+   if not leases.acquire(instanceName, ctx.globalParams.get("workItemLeaseSecs", WORK_ITEM_LEASE_SECS)):
+      tracer.info("[%s] provider instance is being collected by another worker, skipping work item %s" % (providerInstance.fullName,
+                                                                                                           key))
+      return False
+   try:
+      # Other workers may have collected this instance meanwhile
+      providerInstance.readState()
+      processedKeys = providerInstance.state.get("workItemKeys", [])
+      if key in processedKeys:
+         tracer.info("[%s] work item %s has already been processed, skipping" % (providerInstance.fullName,
+                                                                                key))
+         return False
+      tracer.info("[%s] processing work item %s (checks=%s)" % (providerInstance.fullName,
+                                                                key,
+                                                                workItem.get("checks", [])))
+      # A single pass over the dispatched checks (those that are still due);
+      # the next work item is dispatched with the next timer tick
+      scheduler = makeScheduler(tracer, ctx, windowSecs = 0)
+      scheduler.addInstances([providerInstance], checkNames = workItem.get("checks", None))
+      scheduler.run()
+      with providerInstance.stateLock:
+         providerInstance.state["workItemKeys"] = (processedKeys + [key])[-WORK_ITEM_KEYS_KEPT:]
+         providerInstance.writeState()
+   finally:
+      leases.release(instanceName)
+   return True
@@ -16,6 +16,7 @@ PATH_CONTENT       = os.path.join(PATH_PAYLOAD, "content")
 PATH_TRACE         = os.path.join(PATH_ROOT, "trace")
 PATH_STATE         = os.path.join(PATH_ROOT, "state")
 FILENAME_TRACE     = os.path.join(PATH_TRACE, "sapmon.trc")
+FILENAME_CONFIG_SNAPSHOT = os.path.join(PATH_STATE, "keyvault.snapshot")
 
 # Time formats
 TIME_FORMAT_LOG_ANALYTICS = "%a, %d %b %Y %H:%M:%S GMT"
@@ -32,6 +33,52 @@ CONFIG_SECTION_GLOBAL = "-global-"
 METHODNAME_ACTION     = "_action%s"
 STORAGE_ACCESS_KEY_NAME = "storageAccessKey"
 
+# Worker cache (objects kept alive across invocations of a warm Functions worker)
+CACHE_KEY_TRACER       = "tracer"
+CACHE_KEY_CONTEXT      = "context"
+CACHE_KEY_CONFIG       = "config"
+CACHE_KEY_LEASES       = "leases"
+CACHE_TTL_CONTEXT_SECS = 3600
+CACHE_TTL_CONFIG_SECS  = 300
+
+# Check scheduler defaults (can be overwritten in the global config)
+SCHEDULER_MAX_WORKERS  = 8
+SCHEDULER_WINDOW_SECS  = 100
+WORKER_POOL_TYPE       = "thread"
+MAX_PARALLEL_CHECKS_PER_INSTANCE = 4
+
+# Time budgets (the collector has to finish inside the timer period)
+RUN_DEADLINE_SECS      = 110
+CHECK_TIMEOUT_SECS     = 60
+
+# Results are ingested in JSON chunks of at most this size
+# (the Data Collector API of Log Analytics accepts at most 30 MB per post)
+INGEST_MAX_CHUNK_BYTES = 25 * 1024 * 1024
+
+# Checks that only ingest changed results still ingest them at least once per heartbeat
+CHECK_MAX_HEARTBEAT_SECS = 3600
+PROVIDER_TYPE_CONCURRENCY = {
+   "SapHana": 4
+}
+
+# Circuit breaker defaults (can be overwritten in the provider properties)
+CIRCUIT_BREAKER_FAILURE_THRESHOLD  = 3
+CIRCUIT_BREAKER_OPEN_SECS          = 60
+CIRCUIT_BREAKER_PROBE_TIMEOUT_SECS = 2
+CIRCUIT_BREAKER_TRIAL_TIMEOUT_SECS = 120
+
+# Collection modes: collect all provider instances in the timer function (local), or only
+# enqueue one work item per due provider instance and let the queue function collect it (dispatch)
+COLLECTION_MODE_LOCAL    = "local"
+COLLECTION_MODE_DISPATCH = "dispatch"
+WORK_ITEM_LEASE_SECS     = 240
+WORK_ITEM_KEYS_KEPT      = 16
+# Period of the timer function that dispatches the work items (see PersiaTimer/function.json)
+DISPATCH_PERIOD_SECS     = 120
+
+# Resident collector (sapmon.py daemon): length of one scheduling cycle
+DAEMON_CYCLE_SECS = 60
+
 # Naming conventions for generated resources
 KEYVAULT_NAMING_CONVENTION               = "sapmon-kv-%s"
 STORAGE_ACCOUNT_NAMING_CONVENTION        = "sapmonsto%s"
@@ -92,5 +139,10 @@ class JsonFormatter(logging.Formatter):
               record: logging.LogRecord) -> str:
       self._formatTime(record)
       jsonData = self._getJsonData(record)
-      formattedJson = json.dumps(jsonData, cls=self.customJson)
+      if self.customJson:
+         formattedJson = json.dumps(jsonData, cls=self.customJson)
+      else:
+         # Imported here, as tools depends on this module
+         from .tools import JsonBackend
+         formattedJson = JsonBackend.dumps(jsonData)
       return formattedJson
\ No newline at end of file
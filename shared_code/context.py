@@ -11,6 +11,7 @@
 import re
 import sys
 import os
+import threading
 
 # Payload modules
 from __app__.shared_code.tracing import *
@@ -22,11 +23,16 @@ from __app__.shared_code import azure, const
 # Internal context handler
 class Context(object):
    azKv = None
+   configSnapshot = None
+   reconciler = None
+   azLa = None
    sapmonId = None
    vmInstance = None
    vmTage = None
    analyticsTracer = None
    tracer = None
+   storageAccessKey = None
+   configLock = None
 
    globalParams = {}
    instances = []
@@ -36,6 +42,10 @@ class Context(object):
                 operation: str):
       self.tracer = tracer
       self.tracer.info("initializing context")
+      self.globalParams = {}
+      self.instances = []
+      # Serializes config refreshes of the (cached) context across concurrent invocations
+      self.configLock = threading.Lock()
 
       # Retrieve sapmonId via IMDS
       # self.vmInstance = azure.AzureInstanceMetadataService.getComputeInstance(self.tracer, operation)
@@ -58,17 +68,18 @@ class Context(object):
       self.tracer.debug("sapmonId=%s" % self.sapmonId)
       self.tracer.debug("msiClientId=%s" % self.msiClientId)
 
-      # Add storage queue log handler to tracer
-      tracing.addQueueLogHandler(self.tracer, self)
-
-      # Initializing tracer for emitting metrics
-      self.analyticsTracer = tracing.initCustomerAnalyticsTracer(self.tracer, self)
-
-      # Get KeyVault
+      # Get KeyVault (created first, so the log handlers can reuse it for the storage key)
       self.azKv = azure.AzureKeyVault(self.tracer,
                                 const.KEYVAULT_NAMING_CONVENTION % self.sapmonId,
                                 msiClientId = self.msiClientId)
       if not self.azKv.exists():
          sys.exit(const.ERROR_KEYVAULT_NOT_FOUND)
+      self.configSnapshot = azure.AzureKeyVaultSnapshot(self.tracer, self.azKv)
+
+      # Add storage queue log handler to tracer
+      tracing.addQueueLogHandler(self.tracer, self)
+
+      # Initializing tracer for emitting metrics
+      self.analyticsTracer = tracing.initCustomerAnalyticsTracer(self.tracer, self)
 
       self.tracer.info("successfully initialized context")
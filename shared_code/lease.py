@@ -0,0 +1,142 @@
+# Python modules
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+
+# Payload modules
+from .const import *
+from .tools import JsonEncoder, JsonDecoder
+
+###############################################################################
+
+# Exclusive, time-limited leases on provider instances, so that two workers never collect
+# the same instance at the same time
+# Leases are held in memory (workers of the same process) and as lease files in the state
+# directory (workers on other hosts that share the same file system); expired leases
+# of crashed workers are broken by the next worker
+class LeaseManager(object):
+   tracer = None
+   path = None
+   owner = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                path: str = PATH_STATE,
+                owner: str = None):
+      self.tracer = tracer
+      self.path = path
+      self.owner = owner if owner else "%s/%d/%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+      self._held = set()
+      self._lock = threading.Lock()
+
+   # Try to acquire the lease on a provider instance for the given duration
+   # Returns if the lease has been acquired
+   def acquire(self,
+               name: str,
+               durationSecs: int) -> bool:
+      with self._lock:
+         if name in self._held:
+            self.tracer.info("lease on %s is already held by another worker of this process" % name)
+            return False
+         if not self._createLeaseFile(name, durationSecs):
+            return False
+         self._held.add(name)
+      self.tracer.debug("acquired lease on %s (owner=%s, durationSecs=%d)" % (name,
+                                                                             self.owner,
+                                                                             durationSecs))
+      return True
+
+   # Release a lease previously acquired by this worker
+   def release(self,
+               name: str) -> None:
+      with self._lock:
+         self._held.discard(name)
+         filename = self._filename(name)
+         lease = self._readLeaseFile(filename)
+         if lease and lease.get("owner", None) == self.owner:
+            try:
+               os.remove(filename)
+            except FileNotFoundError:
+               pass
+      self.tracer.debug("released lease on %s" % name)
+      return
+
+   def _filename(self,
+                 name: str) -> str:
+      return os.path.join(self.path, "%s.lease" % name)
+
+   # Read a lease file; returns None if it does not exist or cannot be parsed
+   def _readLeaseFile(self,
+                      filename: str) -> Dict[str, object]:
+      try:
+         with open(filename, "r") as file:
+            return json.load(file, object_hook=JsonDecoder.datetimeHook)
+      except FileNotFoundError:
+         return None
+      except Exception as e:
+         self.tracer.warning("could not read lease file %s (%s)" % (filename, e))
+         return None
+
+   @staticmethod
+   def _isExpired(lease: Dict[str, object]) -> bool:
+      expiresAt = lease.get("expiresAt", None) if lease else None
+      return not isinstance(expiresAt, datetime) or expiresAt <= datetime.utcnow()
+
+   # Atomically create the lease file (written aside and then hard-linked into place, so it
+   # never becomes visible without content); an expired lease file is broken first
+   def _createLeaseFile(self,
+                        name: str,
+                        durationSecs: int) -> bool:
+      filename = self._filename(name)
+      lease = {
+         "owner": self.owner,
+         "expiresAt": datetime.utcnow() + timedelta(seconds = durationSecs)
+      }
+      tempFilename = "%s.%s.tmp" % (filename, uuid.uuid4().hex[:8])
+      try:
+         fd = os.open(tempFilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+         with os.fdopen(fd, "w") as file:
+            json.dump(lease, file, cls=JsonEncoder)
+         for attempt in range(2):
+            try:
+               os.link(tempFilename, filename)
+               return True
+            except FileExistsError:
+               pass
+            existing = self._readLeaseFile(filename)
+            if existing and not self._isExpired(existing):
+               self.tracer.info("lease on %s is held by %s until %s" % (name,
+                                                                        existing.get("owner", None),
+                                                                        existing["expiresAt"]))
+               return False
+            # Move the expired lease out of the way (only one worker can do so) and make sure
+            # it has not been replaced by a valid lease in the meantime
+            tombstone = "%s.%s" % (filename, uuid.uuid4().hex[:8])
+            try:
+               os.rename(filename, tombstone)
+            except FileNotFoundError:
+               continue
+            broken = self._readLeaseFile(tombstone)
+            if broken and not self._isExpired(broken):
+               try:
+                  os.link(tombstone, filename)
+               except FileExistsError:
+                  pass
+               os.remove(tombstone)
+               return False
+            os.remove(tombstone)
+            self.tracer.warning("broke expired lease on %s (owner=%s)" % (name,
+                                                                        existing.get("owner", None) if existing else None))
+         return False
+      except Exception as e:
+         self.tracer.error("could not create lease file %s (%s)" % (filename, e))
+         return False
+      finally:
+         try:
+            os.remove(tempFilename)
+         except FileNotFoundError:
+            pass
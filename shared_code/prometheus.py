@@ -5,10 +5,11 @@ import urllib
 
 # Payload modules
 from .context import *
-from .tools import JsonEncoder
+from .tools import JsonBackend, JsonChunkEncoder, TCP
 from . import const
 from .base import ProviderInstance, ProviderCheck
-from typing import Dict
+from .circuitbreaker import EndpointUnreachableError
+from typing import Dict, Iterator
 import logging
 import requests
 import json
@@ -56,8 +57,15 @@ class prometheusProviderInstance(ProviderInstance):
             self.tracer.error("[%s] PrometheusUrl cannot be empty" % self.fullName)
             return False
         self.instance_name = urllib.parse.urlparse(self.metricsUrl).netloc
+        self.initCircuitBreaker(self.metricsUrl, self.probe_endpoint)
         return True
 
+    # Cheap reachability check of the exporter (used while the circuit breaker is open)
+    def probe_endpoint(self) -> bool:
+        url = urllib.parse.urlparse(self.metricsUrl)
+        port = url.port if url.port else (443 if url.scheme == "https" else 80)
+        return TCP.probe(self.tracer, url.hostname, port, const.CIRCUIT_BREAKER_PROBE_TIMEOUT_SECS)
+
     def validate(self) -> bool:
         self.tracer.info("fetching data from %s to validate connection" % self.metricsUrl)
         try:
@@ -72,9 +80,9 @@ class prometheusProviderInstance(ProviderInstance):
             self.tracer.info("Failed to validate %s (%s)" % (self.metricsUrl, err))
         return False
 
-    def fetch_metrics(self) -> str:
+    def fetch_metrics(self, timeout = None) -> str:
         try:
-            resp = requests.get(self.metricsUrl, timeout = self.HTTP_TIMEOUT)
+            resp = requests.get(self.metricsUrl, timeout = timeout if timeout else self.HTTP_TIMEOUT)
             resp.raise_for_status()
             return resp.text
         except Exception as err:
@@ -112,15 +120,43 @@ class prometheusProviderCheck(ProviderCheck):
         self.tracer.info("[%s] Fetching metrics" % self.fullName)
         includeRegex = compile_regexp(includePrefixes, "includePrefixes")
         suppressIfZeroRegex = compile_regexp(suppressIfZeroPrefixes, "suppressIfZeroPrefixes")
-        metricsData = self.providerInstance.fetch_metrics()
-        self.lastResult = (metricsData, includeRegex, suppressIfZeroRegex)
-        if metricsData is None:
-            raise Exception("Unable to fetch metrics")
+        # Fail fast while the exporter is known to be unreachable
+        circuitBreaker = self.providerInstance.circuitBreaker
+        if not circuitBreaker.allowRequest():
+            raise EndpointUnreachableError(circuitBreaker.endpoint,
+                                           "Prometheus endpoint %s is unreachable (circuit breaker is %s)" % (circuitBreaker.endpoint,
+                                                                                                             circuitBreaker.getState()))
+        # Do not wait for the endpoint beyond the deadline of this check
+        (connectTimeout, readTimeout) = self.providerInstance.HTTP_TIMEOUT
+        try:
+            metricsData = self.providerInstance.fetch_metrics(timeout = (self.boundedTimeout(connectTimeout),
+                                                                         self.boundedTimeout(readTimeout)))
+            self.lastResult = (metricsData, includeRegex, suppressIfZeroRegex)
+            if metricsData is None:
+                circuitBreaker.recordFailure()
+                raise Exception("Unable to fetch metrics")
+            circuitBreaker.recordSuccess()
+        finally:
+            circuitBreaker.endTrial()
         if not self.updateState():
             raise Exception("Failed to update state")
 
     # Convert last result into a JSON string (as required by Log Analytics Data Collector API)
     def generateJsonString(self) -> str:
+        self.tracer.info("[%s] converting result set into JSON" % self.fullName)
+        # Use a very compact json representation to limit amount of data parsed by LA
+        resultJsonString = next(JsonChunkEncoder(maxChunkBytes=None).encode(self._generateRecords()))
+        self.tracer.debug("[%s] resultJson=%s" % (self.fullName, str(resultJsonString)[:1000]))
+        return resultJsonString
+
+    # Convert last result into JSON strings, one chunk at a time, as the samples are parsed
+    # (the whole result set is never held in memory, neither as records nor as one string)
+    def generateJsonChunks(self) -> Iterator[str]:
+        self.tracer.info("[%s] converting result set into JSON chunks" % self.fullName)
+        yield from JsonChunkEncoder().encode(self._generateRecords())
+
+    # Generate the records of the last result (the samples of all metrics that pass the filters)
+    def _generateRecords(self) -> Iterator[Dict]:
         # The correlation_id can be used to group fields from the same metrics call
         correlation_id = str(uuid.uuid4())
         fallback_datetime = datetime.now(timezone.utc)
@@ -134,7 +170,7 @@ class prometheusProviderCheck(ProviderCheck):
                 TimeGenerated = datetime.fromtimestamp(sample.timestamp, tz=timezone.utc)
             sample_dict = {
                 "name" : sample.name,
-                "labels" : json.dumps(sample.labels, separators=(',',':'), sort_keys=True, cls=JsonEncoder),
+                "labels" : JsonBackend.dumps(sample.labels, separators=(',',':'), sortKeys=True),
                 "value" : sample.value,
                 self.colTimeGenerated: TimeGenerated,
                 "instance": self.providerInstance.instance,
@@ -172,40 +208,26 @@ class prometheusProviderCheck(ProviderCheck):
         prometheusMetricsText = self.lastResult[0]
         includeRegex = self.lastResult[1]
         suppressIfZeroRegex = self.lastResult[2]
-        resultSet = list()
 
-        self.tracer.info("[%s] converting result set into JSON" % self.fullName)
         try:
             if not prometheusMetricsText:
                 raise ValueError("Empty result from prometheus instance %s", self.providerInstance.instance)
             for family in filter(filter_prometheus_metric,
                                  text_string_to_metric_families(prometheusMetricsText)):
-                resultSet.extend(map(prometheusSample2Dict, filter(filter_prometheus_sample, family.samples)))
+                yield from map(prometheusSample2Dict, filter(filter_prometheus_sample, family.samples))
         except ValueError as e:
             self.tracer.error("[%s] Could not parse prometheus metrics (%s): %s" % (self.fullName, e, prometheusMetricsText))
-            resultSet.append(prometheusSample2Dict(Sample("up", dict(), 0)))
+            yield prometheusSample2Dict(Sample("up", dict(), 0))
         else:
             # The up-metric is used to determine whatever valid data could be read from
             # the prometheus endpoint and is used by prometheus in a similar way
-            resultSet.append(prometheusSample2Dict(Sample("up", dict(), 1)))
-        resultSet.append(prometheusSample2Dict(
+            yield prometheusSample2Dict(Sample("up", dict(), 1))
+        yield prometheusSample2Dict(
             Sample("sapmon",
                    {
                        "SAPMON_VERSION": const.PAYLOAD_VERSION,
                        "PROVIDER_INSTANCE": self.providerInstance.name
-                   }, 1)))
-        # Convert temporary dictionary into JSON string
-        try:
-            # Use a very compact json representation to limit amount of data parsed by LA
-            resultJsonString = json.dumps(resultSet, sort_keys=True,
-                                          separators=(',',':'),
-                                          cls=JsonEncoder)
-            self.tracer.debug("[%s] resultJson=%s" % (self.fullName, str(resultJsonString)[:1000]))
-        except Exception as e:
-            self.tracer.error("[%s] could not format logItem=%s into JSON (%s)" % (self.fullName,
-                                                                                   resultSet[:50],
-                                                                                   e))
-        return resultJsonString
+                   }, 1))
 
     # Update the internal state of this check (including last run times)
     def updateState(self) -> bool:
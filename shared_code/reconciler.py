@@ -0,0 +1,104 @@
+# Python modules
+import hashlib
+import json
+import logging
+from typing import Dict, List
+
+# Payload modules
+from .context import Context
+from .base import ProviderInstance
+from .providerfactory import ProviderFactory
+
+###############################################################################
+
+# Keeps live provider instances across config refreshes and only (re-)creates
+# or tears down the instances whose configuration actually changed
+class ProviderInstanceReconciler(object):
+   tracer = None
+   ctx = None
+   instances = {}
+   failed = set()
+
+   def __init__(self,
+                tracer: logging.Logger,
+                ctx: Context):
+      self.tracer = tracer
+      self.ctx = ctx
+      # instance name -> (config fingerprint, provider instance)
+      self.instances = {}
+      # names of instances whose (current) config could not be instantiated
+      self.failed = set()
+
+   # Calculate a stable fingerprint of the configuration of a provider instance
+   @staticmethod
+   def fingerprint(providerProperties: Dict[str, object]) -> str:
+      canonical = json.dumps(providerProperties, sort_keys=True, separators=(",", ":"))
+      return hashlib.md5(canonical.encode("utf-8")).hexdigest()
+
+   # Bring the live instances in line with the given configs (instance name -> properties)
+   # Returns the list of live provider instances
+   def reconcile(self,
+                 configs: Dict[str, Dict[str, object]]) -> List[ProviderInstance]:
+      self.tracer.info("reconciling %d provider instances" % len(configs))
+      (created, replaced, removed) = (0, 0, 0)
+      self.failed = set()
+
+      # Tear down instances that no longer exist in the config
+      for name in list(self.instances.keys()):
+         if name not in configs:
+            self.tracer.info("provider instance %s has been removed from config" % name)
+            self._teardown(name)
+            removed += 1
+
+      # Create new instances and replace those whose config has changed
+      for (name, providerProperties) in configs.items():
+         if not name:
+            self.tracer.error("cannot reconcile provider instance without a name")
+            continue
+         newFingerprint = self.fingerprint(providerProperties)
+         if name in self.instances:
+            (oldFingerprint, _) = self.instances[name]
+            if oldFingerprint == newFingerprint:
+               continue
+            self.tracer.info("config of provider instance %s has changed, replacing it" % name)
+            self._teardown(name)
+            replaced += 1
+         else:
+            created += 1
+         try:
+            providerInstance = ProviderFactory.makeProviderInstance(providerProperties.get("type", None),
+                                                                    self.tracer,
+                                                                    self.ctx,
+                                                                    providerProperties,
+                                                                    skipContent = False)
+         except Exception as e:
+            self.tracer.error("could not validate provider instance %s (%s)" % (name,
+                                                                               e))
+            self.failed.add(name)
+            continue
+         self.instances[name] = (newFingerprint, providerInstance)
+         self.tracer.debug("successfully loaded config for provider instance %s" % name)
+
+      self.tracer.info("reconciled provider instances (created=%d, replaced=%d, removed=%d, failed=%d, total=%d)" % \
+         (created, replaced, removed, len(self.failed), len(self.instances)))
+      return [i for (_, i) in self.instances.values()]
+
+   # Release all live instances (e.g. when the context is discarded)
+   def teardownAll(self) -> None:
+      for name in list(self.instances.keys()):
+         self._teardown(name)
+      return
+
+   # Release the resources held by a single live instance
+   def _teardown(self,
+                 name: str) -> None:
+      entry = self.instances.pop(name, None)
+      if not entry:
+         return
+      (_, providerInstance) = entry
+      try:
+         providerInstance.close()
+      except Exception as e:
+         self.tracer.warning("[%s] could not close provider instance (%s)" % (providerInstance.fullName,
+                                                                             e))
+      return
@@ -1,13 +1,19 @@
 # Python modules
-import time
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
+from datetime import timedelta
 import hashlib
+import os
+import re
+import threading
+import time
 
 # Payload modules
 from .context import *
 from .tools import *
 from . import const,azure
 from .base import ProviderInstance, ProviderCheck
-from typing import Dict, List
+from .circuitbreaker import EndpointUnreachableError
+from typing import Dict, Iterator, List, Match, Tuple
 
 # SAP HANA modules
 from hdbcli import dbapi
@@ -21,12 +27,216 @@ TIMEOUT_HANA_SECS           = 5
 COL_LOCAL_UTC               = "_LOCAL_UTC"
 COL_SERVER_UTC              = "_SERVER_UTC"
 COL_TIMESERIES_UTC          = "_TIMESERIES_UTC"
+OPEN_END_SERVER_UTC         = "9999-12-31 23:59:59"
 
 # Default retry settings
 RETRY_RETRIES = 3
 RETRY_DELAY_SECS   = 1
 RETRY_BACKOFF_MULTIPLIER = 2
 
+# SQL probe modes (full login vs. plain TCP connect) and number of nodes probed concurrently
+PROBE_MODE_LOGIN   = "login"
+PROBE_MODE_TCP     = "tcp"
+PROBE_MAX_PARALLEL = 8
+
+# Topology of the HANA system (hosts, IPs, roles, timezone offsets and SID), cached by the provider
+# instance and refreshed at this interval (or after a failover); a failed refresh is not retried
+# before this interval has passed either
+# The landscape host configuration is cached entirely, as it is also what the HostConfig check ingests
+# (which refreshes the topology every run, so its rows are always current)
+TOPOLOGY_REFRESH_SECS = 3600
+TOPOLOGY_SQL = "SELECT ip.VALUE AS IP, lhc.*, tz.VALUE AS TIMEZONE_OFFSET, sid.VALUE AS SID " \
+               "FROM SYS.M_LANDSCAPE_HOST_CONFIGURATION lhc " \
+               "LEFT OUTER JOIN SYS.M_HOST_INFORMATION ip ON lhc.HOST = ip.HOST AND ip.KEY = 'net_publicname' " \
+               "LEFT OUTER JOIN SYS.M_HOST_INFORMATION tz ON lhc.HOST = tz.HOST AND UPPER(tz.KEY) = 'TIMEZONE_OFFSET' " \
+               "LEFT OUTER JOIN SYS.M_HOST_INFORMATION sid ON lhc.HOST = sid.HOST AND UPPER(sid.KEY) = 'SID' " \
+               "ORDER BY HOST_ACTIVE DESC, INDEXSERVER_ACTUAL_ROLE ASC"
+TOPOLOGY_COLUMNS = ("TIMEZONE_OFFSET", "SID")
+REGEX_TOPOLOGY_PLACEHOLDER = "\\{(sid|utcOffsetSecs:([A-Za-z0-9_.]+))\\}"
+# Expressions of the topology placeholders while no topology has been loaded (looked up by HANA instead)
+TOPOLOGY_FALLBACK_SID = "(SELECT TOP 1 sidfb.VALUE FROM SYS.M_HOST_INFORMATION sidfb WHERE UPPER(sidfb.KEY) = 'SID')"
+TOPOLOGY_FALLBACK_UTC_OFFSET = "COALESCE((SELECT TOP 1 -TO_INT(tzfb.VALUE) FROM SYS.M_HOST_INFORMATION tzfb WHERE tzfb.HOST = %s AND UPPER(tzfb.KEY) = 'TIMEZONE_OFFSET'), 0)"
+
+# HANA type codes (of the cursor description) of the columns that are converted before JSON encoding
+HANA_TYPE_CONVERTERS = {
+   5:  jsonDecimal,  # DECIMAL
+   47: jsonDecimal,  # SMALLDECIMAL
+   14: jsonDatetime, # DATE
+   16: jsonDatetime, # TIMESTAMP
+   62: jsonDatetime, # SECONDDATE
+   63: jsonDatetime, # DAYDATE
+   12: jsonBytes,    # BINARY
+   13: jsonBytes     # VARBINARY
+}
+
+# Multi-tenant (MDC) mode: connect once to SYSTEMDB, discover the tenant databases together with
+# the topology and run the queries of checks with tenantFanOut across all tenants (through the
+# SYS_DATABASES views; every row is tagged with the DATABASE_NAME of its tenant)
+MULTI_TENANT = False
+TENANTS_SQL = "SELECT DATABASE_NAME FROM SYS.M_DATABASES WHERE ACTIVE_STATUS = 'YES' ORDER BY DATABASE_NAME"
+REGEX_SYS_VIEW = "\\bSYS\\.(M_[A-Za-z0-9_]+)\\b"
+COL_TENANT = "_TENANT"
+COL_DATABASE_NAME = "DATABASE_NAME"
+
+# Number of HANA hosts that are connected to concurrently during failover
+CONNECT_RACE_HOSTS = 3
+
+# Default connection pool settings
+CONNECTION_POOL_SIZE      = 4
+CONNECTION_POOL_IDLE_SECS = 300
+
+# Run the SQL statements of all due checks of an instance on one session
+BATCH_EXECUTION = False
+ACTION_EXECUTE_SQL = "ExecuteSql"
+
+###############################################################################
+
+# Pool of open HANA connections of a provider instance, reused across checks (and warm invocations)
+# Idle connections are pinned to the currently active HANA host, health-checked before they are
+# reused and evicted after being idle for too long; connections inherited by a forked worker
+# process are never reused (nor closed) by that process
+class HanaConnectionPool(object):
+   tracer = None
+   name = None
+   maxIdle = None
+   idleSecs = None
+   pinnedHost = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                name: str,
+                maxIdle: int = CONNECTION_POOL_SIZE,
+                idleSecs: int = CONNECTION_POOL_IDLE_SECS):
+      self.tracer = tracer
+      self.name = name
+      self.maxIdle = maxIdle
+      self.idleSecs = idleSecs
+      self.pinnedHost = None
+      # idle connections as (connection, host, idle since)
+      self._idle = []
+      # cursors with prepared statements per connection (by id of the connection)
+      self._preparedCursors = {}
+      self._lock = threading.Lock()
+      self._pid = os.getpid()
+
+   # Take a healthy idle connection out of the pool
+   # Returns (connection, host) or (None, None) if a new connection has to be established
+   def checkout(self) -> Tuple[pyhdbcli.Connection, str]:
+      with self._lock:
+         self._evict()
+         while self._idle:
+            (connection, host, _) = self._idle.pop()
+            if self._isHealthy(connection):
+               self.tracer.debug("[%s] reusing pooled HANA connection to %s" % (self.name, host))
+               return (connection, host)
+            self.tracer.info("[%s] pooled HANA connection to %s is broken, discarding it" % (self.name, host))
+            self._close(connection)
+      return (None, None)
+
+   # Hand a connection back after use; it is kept for reuse if it is healthy,
+   # connected to the pinned host and the pool is not full yet
+   def checkin(self,
+               connection: pyhdbcli.Connection,
+               host: str) -> None:
+      with self._lock:
+         self._evict()
+         if host == self.pinnedHost and len(self._idle) < self.maxIdle and self._isHealthy(connection):
+            self._idle.append((connection, host, time.monotonic()))
+            return
+      self._close(connection)
+      return
+
+   # Pin the pool to the currently active host; idle connections to any other host are closed
+   def pin(self,
+           host: str) -> None:
+      with self._lock:
+         self._checkPid()
+         if host == self.pinnedHost:
+            return
+         self.tracer.info("[%s] pinning HANA connection pool to %s" % (self.name, host))
+         self.pinnedHost = host
+         stale = [c for (c, h, _) in self._idle if h != host]
+         self._idle = [(c, h, t) for (c, h, t) in self._idle if h == host]
+      for connection in stale:
+         self._close(connection)
+      return
+
+   # Return a cursor of a checked out connection with the given statement prepared on it
+   # Prepared statements are cached per connection, so every statement is only prepared once
+   # per session (and HANA can reuse its plan)
+   def preparedCursor(self,
+                      connection: pyhdbcli.Connection,
+                      sql: str) -> dbapi.Cursor:
+      with self._lock:
+         cursors = self._preparedCursors.setdefault(id(connection), {})
+         cursor = cursors.get(sql, None)
+      if cursor is None:
+         self.tracer.debug("[%s] preparing SQL statement on HANA connection" % self.name)
+         cursor = connection.cursor()
+         cursor.prepare(sql)
+         with self._lock:
+            cursors[sql] = cursor
+      return cursor
+
+   # Close a connection that must not be reused (e.g. after an error)
+   def discard(self,
+               connection: pyhdbcli.Connection) -> None:
+      self._close(connection)
+      return
+
+   # Close all idle connections (e.g. when the provider instance is torn down)
+   def clear(self) -> None:
+      with self._lock:
+         self._checkPid()
+         idle = self._idle
+         self._idle = []
+         self.pinnedHost = None
+      for (connection, _, _) in idle:
+         self._close(connection)
+      return
+
+   # Connections that have been idle for too long are closed (to be called with the lock held)
+   def _evict(self) -> None:
+      self._checkPid()
+      now = time.monotonic()
+      expired = [c for (c, _, t) in self._idle if now - t >= self.idleSecs]
+      if expired:
+         self.tracer.debug("[%s] evicting %d idle HANA connections" % (self.name, len(expired)))
+         self._idle = [(c, h, t) for (c, h, t) in self._idle if now - t < self.idleSecs]
+         for connection in expired:
+            self._close(connection)
+      return
+
+   # Replace the lock inherited by a forked worker process and forget the parent's connections
+   def reinitAfterFork(self) -> None:
+      self._lock = threading.Lock()
+      self._checkPid()
+      return
+
+   # After a fork, the sockets of the idle connections belong to the parent process
+   def _checkPid(self) -> None:
+      if self._pid != os.getpid():
+         self._idle = []
+         self._preparedCursors = {}
+         self._pid = os.getpid()
+      return
+
+   @staticmethod
+   def _isHealthy(connection: pyhdbcli.Connection) -> bool:
+      try:
+         return connection.isconnected()
+      except Exception:
+         return False
+
+   def _close(self,
+              connection: pyhdbcli.Connection) -> None:
+      self._preparedCursors.pop(id(connection), None)
+      try:
+         connection.close()
+      except Exception as e:
+         self.tracer.debug("[%s] could not close HANA connection (%s)" % (self.name, e))
+      return
+
 ###############################################################################
 
 class saphanaProviderInstance(ProviderInstance):
@@ -34,6 +244,12 @@ class saphanaProviderInstance(ProviderInstance):
    hanaDbSqlPort = None
    hanaDbUsername = None
    hanaDbPassword = None
+   connectionPool = None
+   batchExecution = False
+   batchResults = None
+   topologyRefreshSecs = None
+   multiTenant = False
+   tenants = None
 
    def __init__(self,
                 tracer: logging.Logger,
@@ -54,6 +270,11 @@ class saphanaProviderInstance(ProviderInstance):
                        retrySettings,
                        skipContent,
                        **kwargs)
+      # Results of the last batch per check as (batched at, result or error, consumed)
+      self.batchResults = {}
+      self._batchLock = threading.Lock()
+      self._topologyLock = threading.Lock()
+      self._topologyRetryAt = None
 
    # Parse provider properties and fetch DB password from KeyVault, if necessary
    def parseProperties(self):
@@ -108,8 +329,28 @@ class saphanaProviderInstance(ProviderInstance):
             self.tracer.error("[%s] error accessing the secret inside the separate KeyVault (%s)" % (self.fullName,
                                                                                                      e))
             return False        
+      self.initCircuitBreaker("%s:%d" % (self.hanaHostname, self.hanaDbSqlPort),
+                              self._probeHanaEndpoint)
+      self.connectionPool = HanaConnectionPool(self.tracer,
+                                               self.fullName,
+                                               maxIdle = self.providerProperties.get("connectionPoolSize", CONNECTION_POOL_SIZE),
+                                               idleSecs = self.providerProperties.get("connectionPoolIdleSecs", CONNECTION_POOL_IDLE_SECS))
+      self.batchExecution = self.providerProperties.get("batchExecution", BATCH_EXECUTION)
+      self.topologyRefreshSecs = self.providerProperties.get("topologyRefreshSecs", TOPOLOGY_REFRESH_SECS)
+      self.multiTenant = self.providerProperties.get("multiTenant", MULTI_TENANT)
+      self.tenants = self.providerProperties.get("tenants", None)
       return True
 
+   # Cheap reachability check of the SQL port of any known HANA node (used while the circuit breaker is open)
+   def _probeHanaEndpoint(self) -> bool:
+      hosts = [h["ip"] if h.get("ip", None) else h["host"] for h in self.state.get("hostConfig", [])]
+      if self.hanaHostname not in hosts:
+         hosts.append(self.hanaHostname)
+      for host in hosts:
+         if TCP.probe(self.tracer, host, self.hanaDbSqlPort, CIRCUIT_BREAKER_PROBE_TIMEOUT_SECS):
+            return True
+      return False
+
    # Validate that we can establish a HANA connection and run queries
    def validate(self) -> bool:
       self.tracer.info("connecting to HANA instance (%s:%d) to run test query" % (self.hanaHostname,
@@ -139,6 +380,204 @@ class saphanaProviderInstance(ProviderInstance):
          return False
       return True
 
+   # Replace the locks inherited by a forked worker process
+   def reinitAfterFork(self) -> None:
+      super().reinitAfterFork()
+      self._batchLock = threading.Lock()
+      self._topologyLock = threading.Lock()
+      for check in self.checks:
+         check.sqlLock = threading.RLock()
+      if self.connectionPool:
+         self.connectionPool.reinitAfterFork()
+      return
+
+   # Close the pooled HANA connections of this instance
+   def close(self) -> None:
+      super().close()
+      if self.connectionPool:
+         self.connectionPool.clear()
+      return
+
+   # Return the cached topology of the HANA system (None if it has not been loaded yet)
+   # {"sid": ..., "timezoneOffsets": {host: offset in seconds}, "tenants": [...],
+   #  "hostConfigColumns": [...], "hostConfigRows": [[...]], "refreshedAt": ...};
+   # the hosts (with IPs and roles) are kept as host config, which is also used for connection routing
+   def getTopology(self) -> Dict[str, object]:
+      return self.state.get("topology", None)
+
+   # Mark the topology as outdated (e.g. after a failover), so it is refreshed with the next connection
+   def invalidateTopology(self) -> None:
+      with self.stateLock:
+         self._topologyRetryAt = None
+         topology = self.state.get("topology", None)
+         if topology:
+            self.tracer.info("[%s] invalidating HANA topology" % self.fullName)
+            topology["refreshedAt"] = None
+      return
+
+   # Determine if the topology has to be refreshed: it has never been loaded, is outdated or has
+   # been invalidated (and no failed refresh is backing off)
+   def needsTopologyRefresh(self) -> bool:
+      if self._topologyRetryAt is not None and time.monotonic() < self._topologyRetryAt:
+         return False
+      topology = self.getTopology()
+      refreshedAt = topology.get("refreshedAt", None) if topology else None
+      return not refreshedAt or refreshedAt + timedelta(seconds = self.topologyRefreshSecs) <= datetime.utcnow()
+
+   # Refresh the topology on the given connection if needed (or always, if forced); a failed refresh
+   # keeps the previous topology and is not retried before the refresh interval has passed (unless
+   # invalidated or forced)
+   # Returns False if the refresh has failed
+   def refreshTopology(self,
+                       connection: pyhdbcli.Connection,
+                       force: bool = False) -> bool:
+      with self._topologyLock:
+         if not force and not self.needsTopologyRefresh():
+            return True
+         self.tracer.info("[%s] refreshing HANA topology" % self.fullName)
+         try:
+            cursor = self.connectionPool.preparedCursor(connection, TOPOLOGY_SQL)
+            cursor.executeprepared([])
+            columns = [c[0] for c in cursor.description]
+            columnTypes = [c[1] for c in cursor.description]
+            resultRows = cursor.fetchall()
+            tenants = []
+            if self.multiTenant:
+               cursor = self.connectionPool.preparedCursor(connection, TENANTS_SQL)
+               cursor.executeprepared([])
+               tenants = [r["DATABASE_NAME"] for r in cursor.fetchall()
+                          if not self.tenants or r["DATABASE_NAME"] in self.tenants]
+         except Exception as e:
+            self.tracer.warning("[%s] could not refresh HANA topology, retrying in %d seconds (%s)" % (self.fullName,
+                                                                                                      self.topologyRefreshSecs,
+                                                                                                      e))
+            self._topologyRetryAt = time.monotonic() + self.topologyRefreshSecs
+            return False
+         self._topologyRetryAt = None
+         col = {c: idx for (idx, c) in enumerate(columns)}
+         # The host config rows are kept JSON-ready, as they are persisted with the provider state
+         hostConfigPlan = [(idx, HANA_TYPE_CONVERTERS.get(columnTypes[idx], None))
+                           for (idx, c) in enumerate(columns) if c not in TOPOLOGY_COLUMNS]
+         hosts = []
+         hostConfigRows = []
+         timezoneOffsets = {}
+         sid = None
+         for r in resultRows:
+            hosts.append({
+               "host": r[col["HOST"]],
+               "ip": r[col["IP"]],
+               "active": True if r[col["HOST_ACTIVE"]] == "YES" else False,
+               "role": r[col["INDEXSERVER_ACTUAL_ROLE"]]
+            })
+            hostConfigRows.append([r[idx] if convert is None or r[idx] is None else convert(r[idx])
+                                   for (idx, convert) in hostConfigPlan])
+            if r[col["TIMEZONE_OFFSET"]] is not None:
+               timezoneOffsets[r[col["HOST"]]] = int(r[col["TIMEZONE_OFFSET"]])
+            sid = sid if sid else r[col["SID"]]
+         with self.stateLock:
+            if hosts:
+               self.state["hostConfig"] = hosts
+            self.state["topology"] = {
+               "sid": sid,
+               "timezoneOffsets": timezoneOffsets,
+               "tenants": tenants,
+               "hostConfigColumns": [c for c in columns if c not in TOPOLOGY_COLUMNS],
+               "hostConfigRows": hostConfigRows,
+               "version": hashlib.md5(("%s:%s:%s" % (sid, sorted(timezoneOffsets.items()), tenants)).encode("utf-8")).hexdigest(),
+               "refreshedAt": datetime.utcnow()
+            }
+         self.tracer.debug("[%s] topology=%s; hosts=%s" % (self.fullName,
+                                                          self.state["topology"],
+                                                          hosts))
+      return True
+
+   # Take the result of a check from the current batch; if there is none, the SQL statements of
+   # all due checks that the scheduler has queued (and that do not depend on other checks) are run
+   # as a new batch on one session first
+   # Returns (colIndex, resultRows), or None if the check has to run its SQL statement on its own
+   # (e.g. when retrying a failed statement)
+   def takeBatchResult(self,
+                       check: ProviderCheck) -> Tuple[Dict[str, int], List[List[object]]]:
+      with self._batchLock:
+         if not self._hasFreshBatchResult(check):
+            self._runBatch(check)
+         entry = self.batchResults.get(check.name, None)
+         if not entry or entry[2]:
+            return None
+         (batchedAt, result, _) = entry
+         self.batchResults[check.name] = (batchedAt, None, True)
+      if isinstance(result, Exception):
+         raise result
+      return result
+
+   # A batch result is valid for one frequency period of its check, even once consumed
+   def _hasFreshBatchResult(self,
+                            check: ProviderCheck) -> bool:
+      entry = self.batchResults.get(check.name, None)
+      return entry is not None and time.monotonic() - entry[0] < check.frequencySecs
+
+   # Run the SQL statements of the given check and all other due checks that are waiting to be run
+   # by the scheduler on one HANA session (to be called with the batch lock held)
+   # The SQL of another check is only prepared while holding its SQL lock, so it cannot be running
+   # (or start running) meanwhile; checks that are busy are left to run their statements on their own
+   def _runBatch(self,
+                 requestingCheck: ProviderCheck) -> None:
+      batch = [requestingCheck]
+      for check in self.checks:
+         if check is requestingCheck or not check.queued or check.dependsOn or not check.isEnabled() or not check.isDue():
+            continue
+         parameters = check.getSqlParameters()
+         if self._hasFreshBatchResult(check) or not parameters or parameters.get("fetchChunkRows", None):
+            continue
+         if not check.sqlLock.acquire(blocking = False):
+            continue
+         batch.append(check)
+      try:
+         self._runBatchStatements(requestingCheck, batch)
+      finally:
+         for check in batch[1:]:
+            check.sqlLock.release()
+      return
+
+   def _runBatchStatements(self,
+                           requestingCheck: ProviderCheck,
+                           batch: List[ProviderCheck]) -> None:
+      self.tracer.info("[%s] running SQL statements of %d checks as one batch (checks=%s)" % (self.fullName,
+                                                                                             len(batch),
+                                                                                             [c.name for c in batch]))
+
+      # The session is opened on behalf of the requesting check (and fails for it alone)
+      (connection, cursor, host) = requestingCheck._getHanaConnection()
+      if not connection:
+         raise Exception("Unable to get HANA connection")
+      broken = False
+      for check in batch:
+         try:
+            parameters = check.getSqlParameters()
+            (preparedSql, bindParameters) = check._prepareSql(parameters["sql"],
+                                                              parameters.get("isTimeSeries", False),
+                                                              parameters.get("initialTimespanSecs", 60),
+                                                              parameters.get("catchUpWindowSecs", None),
+                                                              parameters.get("tenantFanOut", False))
+            if not preparedSql:
+               raise Exception("Unable to prepare SQL statement")
+            result = check._fetchSqlResult(connection, preparedSql, bindParameters)
+         except Exception as e:
+            result = e
+            broken = not connection.isconnected()
+         self.batchResults[check.name] = (time.monotonic(), result, False)
+         if broken:
+            # The remaining checks will run their statements on their own
+            self.tracer.warning("[%s] HANA session broke during batch, stopping batch after check %s" % (self.fullName,
+                                                                                                     check.name))
+            break
+      if broken:
+         self.connectionPool.discard(connection)
+      else:
+         cursor.close()
+         self.connectionPool.checkin(connection, host)
+      return
+
    def _establishHanaConnectionToHost(self,
                                       hostname: str = None,
                                       port: int = None,
@@ -159,17 +598,54 @@ class saphanaProviderInstance(ProviderInstance):
 # Implements a SAP HANA-specific monitoring check
 class saphanaProviderCheck(ProviderCheck):
    lastResult = None
+   columnTypes = None
+   resultStream = None
+   compiledSql = None
+   catchUpUntil = None
    colTimeGenerated = None
+   sqlLock = None
    
    def __init__(self,
                 provider: ProviderInstance,
                 **kwargs):
-      return super().__init__(provider, **kwargs)
+      super().__init__(provider, **kwargs)
+      self.compiledSql = {}
+      # Held while the SQL statement of this check is prepared and its result is processed
+      # (by the check itself or by a batch run on behalf of another check)
+      self.sqlLock = threading.RLock()
 
    # Obtain one working HANA connection (client-side failover logic)
+   # A pooled connection to the active host is reused if there is one; once done with it,
+   # the connection has to be handed back to the pool of the provider instance (or closed)
+   # Fails fast with EndpointUnreachableError while the circuit breaker of the instance is open
    def _getHanaConnection(self):
       self.tracer.info("[%s] establishing connection with HANA instance" % self.fullName)
+      circuitBreaker = self.providerInstance.circuitBreaker
+      if not circuitBreaker.allowRequest():
+         raise EndpointUnreachableError(circuitBreaker.endpoint,
+                                        "HANA instance %s is unreachable (circuit breaker is %s)" % (circuitBreaker.endpoint,
+                                                                                                    circuitBreaker.getState()))
+      try:
+         (connection, host) = self.providerInstance.connectionPool.checkout()
+         if connection:
+            cursor = connection.cursor()
+         else:
+            (connection, cursor, host) = self._connectToHana()
+            if not connection:
+               circuitBreaker.recordFailure()
+               return (None, None, None)
+            circuitBreaker.recordSuccess()
+            self.providerInstance.connectionPool.pin(host)
+      finally:
+         # A trial request that neither succeeded nor failed (e.g. pooled or cancelled) must not block the breaker
+         circuitBreaker.endTrial()
+
+      # Keep the cached topology up to date (refreshed once outdated or after a failover)
+      self.providerInstance.refreshTopology(connection)
+      return (connection, cursor, host)
 
+   # Try all known HANA nodes and, as a last resort, the host from the user config
+   def _connectToHana(self):
       # Check if HANA host config has been retrieved from DB yet
       if "hostConfig" not in self.providerInstance.state:
          # Host config has not been retrieved yet; our only candidate is the one provided by user
@@ -180,32 +656,38 @@ class saphanaProviderCheck(ProviderCheck):
          self.tracer.debug("[%s] host config has been persisted to provider, deriving prioritized host list" % self.fullName)
          hostConfig = self.providerInstance.state["hostConfig"]
          hostsToTry = [h["ip"] if h.get("ip", None) else h["host"] for h in hostConfig]
+         # The host that won the last connection attempt is most likely still the active one
+         preferredHost = self.providerInstance.state.get("preferredHost", None)
+         if preferredHost in hostsToTry:
+            hostsToTry.remove(preferredHost)
+            hostsToTry.insert(0, preferredHost)
 
-      # Iterate through the prioritized list of hosts to try
-      cursor = None
+      # Race the prioritized hosts in batches of raceHosts, so failover takes one timeout per batch
+      # instead of one timeout per host
       self.tracer.debug("hostsToTry=%s" % hostsToTry)
-      for host in hostsToTry:
-         try:
-            connection = self.providerInstance._establishHanaConnectionToHost(hostname = host)
-            # Validate that we're indeed connected
-            if connection.isconnected():
-               cursor = connection.cursor()
-               break
-         except Exception as e:
-            self.tracer.warning("[%s] could not connect to HANA node %s:%d (%s)" % (self.fullName,
-                                                                                    host,
-                                                                                    self.providerInstance.hanaDbSqlPort,
-                                                                                    e))
-      # If we were able to establish a connection, we're done
-      if cursor:
-         return (connection, cursor, host)
+      raceHosts = max(1, self.providerInstance.providerProperties.get("connectRaceHosts", CONNECT_RACE_HOSTS))
+      for i in range(0, len(hostsToTry), raceHosts):
+         (connection, host) = self._raceHanaConnection(hostsToTry[i:i + raceHosts])
+         # If we were able to establish a connection, we're done
+         if connection:
+            with self.providerInstance.stateLock:
+               previousHost = self.providerInstance.state.get("preferredHost", None)
+               self.providerInstance.state["preferredHost"] = host
+            # Another host than last time has won: the roles in the landscape have probably changed
+            if previousHost and previousHost != host:
+               self.tracer.info("[%s] active HANA host changed from %s to %s" % (self.fullName,
+                                                                                 previousHost,
+                                                                                 host))
+               self.providerInstance.invalidateTopology()
+            return (connection, connection.cursor(), host)
 
       # Our last chance: Forget HANA's current host config and try out the original user config
       self.tracer.error("[%s] unable to connect to any HANA node (hosts to try=%s)" % (self.fullName,
                                                                                        hostsToTry))
       self.tracer.info("[%s] trying with connection from user config" % self.fullName)
       try:
-         connection = self.providerInstance._establishHanaConnectionToHost(hostname = self.providerInstance.hanaHostname)
+         connection = self.providerInstance._establishHanaConnectionToHost(hostname = self.providerInstance.hanaHostname,
+                                                                           timeout = self.boundedTimeout(TIMEOUT_HANA_SECS))
          if connection.isconnected():
             cursor = connection.cursor()
             self.tracer.info("[%s] connection %s:%d from user config worked; forgetting host config" % (self.fullName,
@@ -213,7 +695,9 @@ class saphanaProviderCheck(ProviderCheck):
                                                                                                         self.providerInstance.hanaDbSqlPort))
             # Give up and remove current host config, so a "fresh" host config will be pulled next time
             # This is for HA/DR scenarios where customers connected against a vIP and a failover just happened
-            self.providerInstance.state.pop("hostConfig")
+            self.providerInstance.state.pop("hostConfig", None)
+            self.providerInstance.state.pop("preferredHost", None)
+            self.providerInstance.invalidateTopology()
             # Update internal state
             if not self.updateState():
                raise Exception("Failed to update state")
@@ -226,53 +710,211 @@ class saphanaProviderCheck(ProviderCheck):
                                                                                      e))
       return (None, None, None)
 
+   # Connect to all given hosts concurrently and keep the first connection that succeeds
+   # Connections that lose the race are closed as soon as they have been established
+   # Returns (connection, host) or (None, None) if none of the hosts could be reached
+   def _raceHanaConnection(self,
+                           hosts: List[str]) -> Tuple[pyhdbcli.Connection, str]:
+      timeout = self.boundedTimeout(TIMEOUT_HANA_SECS)
+
+      def connect(host: str) -> pyhdbcli.Connection:
+         try:
+            connection = self.providerInstance._establishHanaConnectionToHost(hostname = host,
+                                                                              timeout = timeout)
+            # Validate that we're indeed connected
+            if connection.isconnected():
+               return connection
+            connection.close()
+         except Exception as e:
+            self.tracer.warning("[%s] could not connect to HANA node %s:%d (%s)" % (self.fullName,
+                                                                                    host,
+                                                                                    self.providerInstance.hanaDbSqlPort,
+                                                                                    e))
+         return None
+
+      if len(hosts) == 1:
+         connection = connect(hosts[0])
+         return (connection, hosts[0]) if connection else (None, None)
+
+      (winner, winnerHost) = (None, None)
+      executor = ThreadPoolExecutor(max_workers = len(hosts))
+      futures = {executor.submit(connect, host): host for host in hosts}
+      try:
+         for future in as_completed(futures):
+            connection = future.result()
+            if connection:
+               (winner, winnerHost) = (connection, futures[future])
+               break
+      finally:
+         executor.shutdown(wait = False)
+
+      def closeLoser(future: Future) -> None:
+         connection = future.result()
+         if connection and connection is not winner:
+            self.tracer.debug("[%s] closing connection to HANA node %s (lost the race against %s)" % (self.fullName,
+                                                                                                      futures[future],
+                                                                                                      winnerHost))
+            connection.close()
+      for future in futures:
+         future.add_done_callback(closeLoser)
+      return (winner, winnerHost)
+
    # Prepare the SQL statement based on the check-specific query
+   # Returns (SQL statement, bind parameters); the statement is the same for every run of this check
+   # With catchUpWindowSecs, a time series that is lagging behind by more than two windows is
+   # fetched one window at a time (if the query has an {untilServerUtc} condition)
+   # With tenantFanOut (in multi-tenant mode), the time conditions are bound per tenant database
    def _prepareSql(self,
                    sql: str,
                    isTimeSeries: bool,
-                   initialTimespanSecs: int) -> str:
+                   initialTimespanSecs: int,
+                   catchUpWindowSecs: int = None,
+                   tenantFanOut: bool = False) -> Tuple[str, List[object]]:
       self.tracer.info("[%s] preparing SQL statement" % self.fullName)
+      (preparedSql, bindNames) = self._compileSql(sql,
+                                                  isTimeSeries,
+                                                  initialTimespanSecs,
+                                                  tenantFanOut)
+      self.catchUpUntil = {}
+      bindValues = {}
+      for tenant in dict.fromkeys([t for (_, t) in bindNames]):
+         bindValues[("databaseName", tenant)] = tenant
+         if not isTimeSeries:
+            continue
+         # If time series, bind the time condition (NULL applies the initial timespan)
+         window = self._getTimeSeriesWindow(tenant,
+                                            initialTimespanSecs,
+                                            catchUpWindowSecs if ("untilServerUtc", tenant) in bindNames else None)
+         if not window:
+            return (None, None)
+         (bindValues[("lastRunServerUtc", tenant)], bindValues[("untilServerUtc", tenant)]) = window
+      return (preparedSql, [bindValues[b] for b in bindNames])
 
-      # Insert logic to get server UTC time (_SERVER_UTC)
-      sqlTimestamp = ", CURRENT_UTCTIMESTAMP AS %s FROM DUMMY," % COL_SERVER_UTC
-      self.tracer.debug("[%s] sqlTimestamp=%s" % (self.fullName,
-                                                  sqlTimestamp))
-      preparedSql = sql.replace(" FROM", sqlTimestamp, 1)
-      
-      # If time series, insert time condition
-      if isTimeSeries:
+   # Determine the time window of a time series (of a single tenant database, if fanned out)
+   # Returns (lastRunServer, catchUpUntil), where None applies the initial timespan or leaves the
+   # window open-ended, respectively; None if the last run could not be determined
+   def _getTimeSeriesWindow(self,
+                            tenant: str,
+                            initialTimespanSecs: int,
+                            catchUpWindowSecs: int = None) -> Tuple[datetime, datetime]:
+      scope = self.fullName if tenant is None else "%s/%s" % (self.fullName, tenant)
+      if tenant is None:
          lastRunServer = self.state.get("lastRunServer", None)
+      else:
+         lastRunServer = self.state.get("tenantLastRunServer", {}).get(tenant, None)
+      if not lastRunServer:
+         self.tracer.info("[%s] time series query has never been run, applying initalTimespanSecs=%d" % \
+            (scope, initialTimespanSecs))
+         return (None, None)
+      if not isinstance(lastRunServer, datetime):
+         self.tracer.error("[%s] lastRunServer=%s could not been de-serialized into datetime object" % (scope,
+                                                                                                        str(lastRunServer)))
+         return None
+      self.tracer.info("[%s] time series query has been run at %s, filter out only new records since then" % \
+         (scope, lastRunServer))
+      if catchUpWindowSecs:
+         catchUpUntil = lastRunServer + timedelta(seconds = catchUpWindowSecs)
+         if catchUpUntil + timedelta(seconds = catchUpWindowSecs) < datetime.utcnow():
+            self.tracer.info("[%s] catching up on time series, only fetching records until %s" % (scope,
+                                                                                                catchUpUntil))
+            self.catchUpUntil[tenant] = catchUpUntil
+            return (lastRunServer, catchUpUntil)
+      return (lastRunServer, None)
 
-         # TODO(tniek) - make WHERE conditions for time series queries more flexible
-         if not lastRunServer:
-            self.tracer.info("[%s] time series query has never been run, applying initalTimespanSecs=%d" % \
-               (self.fullName, initialTimespanSecs))
-            lastRunServerUtc = "ADD_SECONDS(NOW(), MAP(hi.VALUE, null, -%d, hi.VALUE*(-1))-%d)" % (initialTimespanSecs, initialTimespanSecs)
-         else:
-            if not isinstance(lastRunServer, datetime):
-               self.tracer.error("[%s] lastRunServer=%s could not been de-serialized into datetime object" % (self.fullName,
-                                                                                                              str(lastRunServer)))
-               return None
-            try:
-               lastRunServerUtc = "'%s'" % lastRunServer.strftime(TIME_FORMAT_HANA)
-            except Exception as e:
-               self.tracer.error("[%s] could not format lastRunServer=%s into HANA format (%s)" % (self.fullName,
-                                                                                                   str(lastRunServer),
-                                                                                                   e))
-               return None
-            self.tracer.info("[%s] time series query has been run at %s, filter out only new records since then" % \
-               (self.fullName, lastRunServerUtc))
-         self.tracer.debug("[%s] lastRunServerUtc=%s" % (self.fullName,
-                                                         lastRunServerUtc))
-         preparedSql = sql.replace("{lastRunServerUtc}", lastRunServerUtc, 1)
-         self.tracer.debug("[%s] preparedSql=%s" % (self.fullName,
-                                                    preparedSql))
-
-      # Return the finished SQL statement
-      return preparedSql
+   # Compile the check-specific query into the SQL statement that is run (once per query and
+   # topology, then cached)
+   # The time conditions of time series are bind parameters instead of literals, so HANA always
+   # sees the same SQL text and can reuse the plan of the prepared statement
+   # With tenantFanOut (in multi-tenant mode), the query is run once per tenant database as part
+   # of a single UNION ALL statement, reading the SYS_DATABASES views instead of the SYS views
+   # Returns (SQL statement, (name, tenant) of the bind parameters in the order of their placeholders)
+   def _compileSql(self,
+                   sql: str,
+                   isTimeSeries: bool,
+                   initialTimespanSecs: int,
+                   tenantFanOut: bool = False) -> Tuple[str, List[Tuple[str, str]]]:
+      topology = self.providerInstance.getTopology()
+      fanOut = tenantFanOut and self.providerInstance.multiTenant
+      key = (sql, isTimeSeries, initialTimespanSecs, fanOut, topology.get("version", None) if topology else None)
+      if key in self.compiledSql:
+         return self.compiledSql[key]
+
+      # Insert the cached topology instead of joining it in every run: {sid} and
+      # {utcOffsetSecs:<host column>} (the offset that converts server-local times of that host into UTC)
+      sql = re.sub(REGEX_TOPOLOGY_PLACEHOLDER,
+                   lambda m: self._topologyExpression(topology, m.group(1), m.group(2)),
+                   sql)
+
+      # If time series, insert time conditions: records after {lastRunServerUtc} (or within the
+      # initial timespan) and, optionally, up to {untilServerUtc} (open-ended unless catching up)
+      # (time series queries bring their own time column and are not extended by _SERVER_UTC)
+      # TODO(tniek) - make WHERE conditions for time series queries more flexible
+      bindExpressions = {}
+      if isTimeSeries:
+         initialRunServerUtc = "ADD_SECONDS(CURRENT_UTCTIMESTAMP, -%d)" % initialTimespanSecs
+         bindExpressions = {
+            "lastRunServerUtc": "COALESCE(CAST(? AS TIMESTAMP), %s)" % initialRunServerUtc,
+            "untilServerUtc": "COALESCE(CAST(? AS TIMESTAMP), TO_TIMESTAMP('%s'))" % OPEN_END_SERVER_UTC
+         }
+      else:
+         # Insert logic to get server UTC time (_SERVER_UTC)
+         sqlTimestamp = ", CURRENT_UTCTIMESTAMP AS %s FROM DUMMY," % COL_SERVER_UTC
+         sql = sql.replace(" FROM", sqlTimestamp, 1)
+
+      # If fanned out, read the views of {databaseName} and tag each row with it (as _TENANT)
+      tenants = [None]
+      if fanOut:
+         tenants = topology.get("tenants", None) if topology else None
+         if not tenants:
+            raise Exception("no tenant databases have been discovered (required for tenantFanOut)")
+         bindExpressions["databaseName"] = "?"
+         sql = "SELECT CAST({databaseName} AS NVARCHAR(256)) AS %s, q.* FROM (%s) q" % \
+            (COL_TENANT, re.sub(REGEX_SYS_VIEW, "(SELECT * FROM SYS_DATABASES.\\1 WHERE DATABASE_NAME = {databaseName})", sql))
+
+      # Replace the placeholders by bind parameters (once per tenant database, if fanned out)
+      bindNames = []
+      branches = []
+      for tenant in tenants:
+         def bind(m: Match) -> str:
+            bindNames.append((m.group(1), tenant))
+            return bindExpressions[m.group(1)]
+         branches.append(re.sub("\\{(%s)\\}" % "|".join(bindExpressions), bind, sql) if bindExpressions else sql)
+      compiledSql = " UNION ALL ".join(branches)
+      self.tracer.debug("[%s] compiledSql=%s; bindNames=%s" % (self.fullName,
+                                                              compiledSql,
+                                                              bindNames))
+      self.compiledSql = {k: v for (k, v) in self.compiledSql.items() if k[:4] != key[:4]}
+      self.compiledSql[key] = (compiledSql, bindNames)
+      return (compiledSql, bindNames)
+
+   # Build the SQL expression of a topology placeholder from the cached topology
+   # (while no topology has been loaded, HANA looks the values up itself)
+   def _topologyExpression(self,
+                           topology: Dict[str, object],
+                           placeholder: str,
+                           hostColumn: str) -> str:
+      if not topology:
+         self.tracer.info("[%s] HANA topology has not been loaded, looking up {%s} in query" % (self.fullName,
+                                                                                              placeholder))
+         return TOPOLOGY_FALLBACK_SID if placeholder == "sid" else TOPOLOGY_FALLBACK_UTC_OFFSET % hostColumn
+      if placeholder == "sid":
+         sid = topology.get("sid", None)
+         return "'%s'" % sid.replace("'", "''") if sid else "NULL"
+      offsets = topology.get("timezoneOffsets", {})
+      if not offsets:
+         return "0"
+      cases = ", ".join(["'%s', %d" % (h.replace("'", "''"), -o) for (h, o) in sorted(offsets.items())])
+      return "MAP(%s, %s, 0)" % (hostColumn, cases)
+
+   # Determine the columns that make up the hash of a result set: internal columns (such as
+   # the server time added to every query) are left out, so the hash only changes with the data
+   @staticmethod
+   def _hashedColumns(colIndex: Dict[str, int]) -> List[int]:
+      return sorted([idx for (c, idx) in colIndex.items() if not c.startswith("_")])
 
    # Calculate the MD5 hash of a result set
    def _calculateResultHash(self,
+                            colIndex: Dict[str, int],
                             resultRows: List[List[str]]) -> str:
       self.tracer.info("[%s] calculating hash of SQL query result" % self.fullName)
       if len(resultRows) == 0:
@@ -280,7 +922,9 @@ class saphanaProviderCheck(ProviderCheck):
          return None
       resultHash = None
       try:
-         resultHash = hashlib.md5(str(resultRows).encode("utf-8")).hexdigest()
+         rowHasher = RowHasher(self._hashedColumns(colIndex))
+         rowHasher.updateRows(resultRows)
+         resultHash = rowHasher.hexdigest()
          self.tracer.debug("resultHash=%s" % resultHash)
       except Exception as e:
          self.tracer.error("[%s] could not calculate result hash (%s)" % (self.fullName,
@@ -291,87 +935,291 @@ class saphanaProviderCheck(ProviderCheck):
    # This string will be ingested into Log Analytics and Customer Analytics
    def generateJsonString(self) -> str:
       self.tracer.info("[%s] converting SQL query result set into JSON format" % self.fullName)
-      logData = []
+      # A streamed result has to be fetched entirely to fit into one string
+      if self.resultStream:
+         self._drainResultStream()
 
       # Only loop through the result if there is one
       if self.lastResult:
          (colIndex, resultRows) = self.lastResult
-         # Iterate through all rows of the last query result
-         for r in resultRows:
-            logItem = {
-               "SAPMON_VERSION": PAYLOAD_VERSION,
-               "PROVIDER_INSTANCE": self.providerInstance.name,
-               "METADATA": self.providerInstance.metadata
-            }
-            for c in colIndex.keys():
-               # Unless it's the column mapped to TimeGenerated, remove internal fields
-               if c != self.colTimeGenerated and (c.startswith("_") or c == "DUMMY"):
-                  continue
-               logItem[c] = r[colIndex[c]]
-            logData.append(logItem)
+         return self._formatJsonString(colIndex, resultRows)
+      return self._formatJsonString({}, [])
+
+   # Generate the JSON-encoded strings with the last query result, one chunk at a time
+   # (a chunk is cut whenever it would exceed INGEST_MAX_CHUNK_BYTES)
+   # A streamed result is fetched in chunks of fetchChunkRows rows and each chunk is converted
+   # and handed over for ingestion right away, so only one chunk is held in memory; the internal
+   # state is updated once the entire result has been fetched
+   def generateJsonChunks(self) -> Iterator[str]:
+      if not self.resultStream:
+         self.tracer.info("[%s] converting SQL query result set into JSON format" % self.fullName)
+         (colIndex, resultRows) = self.lastResult if self.lastResult else ({}, [])
+         rowConverter = self._getRowConverter(colIndex)
+         yield from JsonChunkEncoder().encode(rowConverter.convert(r) for r in resultRows)
+         return
+      (connection, cursor, host, colIndex, fetchChunkRows) = self.resultStream
+      self.resultStream = None
+      completed = False
+      try:
+         # Same digest as _calculateResultHash of the entire result set, calculated chunk by chunk
+         rowHasher = RowHasher(self._hashedColumns(colIndex))
+         rowConverter = self._getRowConverter(colIndex)
+         jsonEncoder = JsonChunkEncoder()
+         (firstRow, lastRow, rowCount) = (None, None, 0)
+         tenantLastRows = {}
+         while True:
+            resultRows = cursor.fetchmany(fetchChunkRows)
+            if not resultRows:
+               break
+            rowHasher.updateRows(resultRows)
+            self._trackTenantLastRows(colIndex, resultRows, tenantLastRows)
+            rowCount += len(resultRows)
+            if firstRow is None:
+               firstRow = resultRows[0]
+            lastRow = resultRows[-1]
+            self.tracer.info("[%s] fetched chunk of %d rows (%d rows so far)" % (self.fullName,
+                                                                               len(resultRows),
+                                                                               rowCount))
+            for r in resultRows:
+               resultJson = jsonEncoder.add(rowConverter.convert(r))
+               if resultJson:
+                  yield resultJson
+            yield jsonEncoder.flush()
+         completed = True
+      finally:
+         # The connection is only reused if the entire result has been fetched
+         if completed:
+            self.providerInstance.connectionPool.checkin(connection, host)
+         else:
+            self.providerInstance.connectionPool.discard(connection)
+      if rowCount == 0:
+         yield self._formatJsonString(colIndex, [])
+      if not self._updateState(colIndex,
+                               firstRow,
+                               lastRow,
+                               rowHasher.hexdigest() if rowCount > 0 else None,
+                               tenantLastRows):
+         raise Exception("Failed to update state")
+
+   # Fetch the remainder of a streamed result into the last result and update the internal state
+   def _drainResultStream(self) -> None:
+      (connection, cursor, host, colIndex, fetchChunkRows) = self.resultStream
+      self.resultStream = None
+      try:
+         resultRows = cursor.fetchall()
+      except Exception:
+         self.providerInstance.connectionPool.discard(connection)
+         raise
+      self.providerInstance.connectionPool.checkin(connection, host)
+      self.lastResult = (colIndex, resultRows)
+      if not self.updateState():
+         raise Exception("Failed to update state")
+
+   # Close a streamed result that has not been consumed (e.g. by a previous, failed execution)
+   def _closeResultStream(self) -> None:
+      if not self.resultStream:
+         return
+      self.tracer.warning("[%s] discarding unconsumed result stream" % self.fullName)
+      (connection, _, _, _, _) = self.resultStream
+      self.resultStream = None
+      self.providerInstance.connectionPool.discard(connection)
+
+   # Build the column-wise converter of a result set from the column types of its cursor description
+   # (columns without a known type are left to the JSON encoder)
+   def _getRowConverter(self,
+                        colIndex: Dict[str, int]) -> RowConverter:
+      plan = []
+      for (c, idx) in colIndex.items():
+         # Unless it's the column mapped to TimeGenerated, remove internal fields
+         if c != self.colTimeGenerated and (c.startswith("_") or c == "DUMMY"):
+            continue
+         typeCode = self.columnTypes[idx] if self.columnTypes and idx < len(self.columnTypes) else None
+         plan.append((c, idx, HANA_TYPE_CONVERTERS.get(typeCode, None)))
+      return RowConverter(plan, {
+         "SAPMON_VERSION": PAYLOAD_VERSION,
+         "PROVIDER_INSTANCE": self.providerInstance.name,
+         "METADATA": self.providerInstance.metadata
+      })
+
+   # Convert result rows into a JSON-encoded string
+   def _formatJsonString(self,
+                         colIndex: Dict[str, int],
+                         resultRows: List[List[object]]) -> str:
+      logData = self._getRowConverter(colIndex).convertRows(resultRows)
 
       # Convert temporary dictionary into JSON string
       try:
-         resultJsonString = json.dumps(logData, sort_keys=True, indent=4, cls=JsonEncoder)
+         resultJsonString = JsonBackend.dumps(logData, sortKeys = True, separators = (",", ":"))
          self.tracer.debug("[%s] resultJson=%s" % (self.fullName,
                                                    str(resultJsonString)))
       except Exception as e:
          self.tracer.error("[%s] could not format logItem=%s into JSON (%s)" % (self.fullName,
-                                                                                logItem,
+                                                                                logData[-1] if logData else None,
                                                                                 e))
       return resultJsonString
 
    # Update the internal state of this check (including last run times)
    def updateState(self) -> bool:
-      self.tracer.info("[%s] updating internal state" % self.fullName)
       (colIndex, resultRows) = self.lastResult
+      tenantLastRows = {}
+      self._trackTenantLastRows(colIndex, resultRows, tenantLastRows)
+      return self._updateState(colIndex,
+                               resultRows[0] if len(resultRows) > 0 else None,
+                               resultRows[-1] if len(resultRows) > 0 else None,
+                               self._calculateResultHash(colIndex, resultRows),
+                               tenantLastRows)
+
+   # Keep track of the last row of each tenant database in a fanned-out result
+   @staticmethod
+   def _trackTenantLastRows(colIndex: Dict[str, int],
+                            resultRows: List[List[object]],
+                            tenantLastRows: Dict[str, List[object]]) -> None:
+      if COL_TENANT not in colIndex:
+         return
+      idx = colIndex[COL_TENANT]
+      for r in resultRows:
+         tenantLastRows[r[idx]] = r
+      return
+
+   # Update the internal state from the first and last row (also per tenant database, if fanned out)
+   # and the hash of a result set
+   def _updateState(self,
+                    colIndex: Dict[str, int],
+                    firstRow: List[object],
+                    lastRow: List[object],
+                    resultHash: str,
+                    tenantLastRows: Dict[str, List[object]] = None) -> bool:
+      self.tracer.info("[%s] updating internal state" % self.fullName)
 
       # Always store lastRunLocal; if the check result doesn't have it, use current time
-      if COL_LOCAL_UTC in colIndex:
-         lastRunLocal = resultRows[0][colIndex[COL_LOCAL_UTC]]
+      if COL_LOCAL_UTC in colIndex and firstRow is not None:
+         lastRunLocal = firstRow[colIndex[COL_LOCAL_UTC]]
       else:
          lastRunLocal = datetime.utcnow()
       self.state["lastRunLocal"] = lastRunLocal
 
       # Only store lastRunServer if we have it in the check result; consider time-series queries
-      if len(resultRows) > 0:
+      if firstRow is not None:
          if COL_TIMESERIES_UTC in colIndex:
-            self.state["lastRunServer"] = resultRows[-1][colIndex[COL_TIMESERIES_UTC]]
+            self.state["lastRunServer"] = lastRow[colIndex[COL_TIMESERIES_UTC]]
          elif COL_SERVER_UTC in colIndex:
-            self.state["lastRunServer"] = resultRows[0][colIndex[COL_SERVER_UTC]]
+            self.state["lastRunServer"] = firstRow[colIndex[COL_SERVER_UTC]]
+
+      # Fanned-out time series keep track of the last record per tenant database
+      if tenantLastRows and COL_TIMESERIES_UTC in colIndex:
+         tenantLastRunServer = self.state.setdefault("tenantLastRunServer", {})
+         for (tenant, r) in tenantLastRows.items():
+            tenantLastRunServer[tenant] = r[colIndex[COL_TIMESERIES_UTC]]
+
+      # A window of a catch-up has been fetched entirely: the next window starts where this one
+      # ended (even if there were no records in it) and is fetched right away
+      if self.catchUpUntil:
+         for (tenant, catchUpUntil) in self.catchUpUntil.items():
+            if tenant is None:
+               self.state["lastRunServer"] = catchUpUntil
+            else:
+               self.state.setdefault("tenantLastRunServer", {})[tenant] = catchUpUntil
+         self.catchUpUntil = None
+         self.catchingUp = True
 
-      self.state["lastResultHash"] = self._calculateResultHash(resultRows)
+      self.resultChanged = (resultHash != self.state.get("lastResultHash", None))
+      self.state["lastResultHash"] = resultHash
       self.tracer.info("[%s] internal state successfully updated" % self.fullName)
       return True
 
+   # Return the parameters of the ExecuteSql action of this check
+   # (None if the check does not have exactly one such action)
+   def getSqlParameters(self) -> Dict[str, object]:
+      sqlActions = [a for a in self.actions if a["type"] == ACTION_EXECUTE_SQL]
+      if len(sqlActions) != 1:
+         return None
+      return sqlActions[0].get("parameters", {})
+
+   # Execute a prepared SQL statement on an open connection and fetch its entire result
+   # Returns (colIndex, resultRows)
+   def _fetchSqlResult(self,
+                       connection: pyhdbcli.Connection,
+                       preparedSql: str,
+                       parameters: List[object]) -> Tuple[Dict[str, int], List[List[object]]]:
+      (cursor, colIndex) = self._executeStatement(connection, preparedSql, parameters)
+      resultRows = cursor.fetchall()
+      return (colIndex, resultRows)
+
+   # Execute a prepared SQL statement on an open connection (using the cached prepared statement)
+   # Returns (cursor, colIndex) of its result set
+   def _executeStatement(self,
+                         connection: pyhdbcli.Connection,
+                         preparedSql: str,
+                         parameters: List[object]) -> Tuple[dbapi.Cursor, Dict[str, int]]:
+      self.tracer.debug("[%s] executing SQL statement %s (parameters=%s)" % (self.fullName,
+                                                                            preparedSql,
+                                                                            parameters))
+      cursor = self.providerInstance.connectionPool.preparedCursor(connection, preparedSql)
+      cursor.executeprepared(parameters)
+      colIndex = {col[0] : idx for idx, col in enumerate(cursor.description)}
+      self.columnTypes = [col[1] for col in cursor.description]
+      # Rows of a fanned-out query are tagged with their tenant database (unless the query has it already)
+      if COL_TENANT in colIndex and COL_DATABASE_NAME not in colIndex:
+         colIndex[COL_DATABASE_NAME] = colIndex[COL_TENANT]
+      return (cursor, colIndex)
+
    # Connect to HANA and run the check-specific SQL statement
+   # In batch mode, the result is taken from the batch of the provider instance instead
+   # With fetchChunkRows, the result is not fetched here but streamed in chunks of that many rows
+   # when the result is ingested (the last action of the check), and the internal state is only
+   # updated once the entire result has been fetched
    def _actionExecuteSql(self,
                     sql: str,
                     isTimeSeries: bool = False,
-                    initialTimespanSecs: int = 60) -> None:
-      self.tracer.info("[%s] connecting to HANA and executing SQL" % self.fullName)
+                    initialTimespanSecs: int = 60,
+                    fetchChunkRows: int = None,
+                    catchUpWindowSecs: int = None,
+                    tenantFanOut: bool = False) -> None:
+      # Under the SQL lock, so a batch run on behalf of another check cannot prepare this check meanwhile
+      with self.sqlLock:
+         self._runSql(sql,
+                      isTimeSeries,
+                      initialTimespanSecs,
+                      fetchChunkRows,
+                      catchUpWindowSecs,
+                      tenantFanOut)
 
+   def _runSql(self,
+               sql: str,
+               isTimeSeries: bool,
+               initialTimespanSecs: int,
+               fetchChunkRows: int,
+               catchUpWindowSecs: int,
+               tenantFanOut: bool) -> None:
       # Marking which column will be used for TimeGenerated
       self.colTimeGenerated = COL_TIMESERIES_UTC if isTimeSeries else COL_SERVER_UTC
+      self._closeResultStream()
 
-      # Find and connect to HANA server
-      (connection, cursor, host) = self._getHanaConnection()
-      if not connection:
-         raise Exception("Unable to get HANA connection")
+      if fetchChunkRows:
+         if self.actions[-1]["type"] != ACTION_EXECUTE_SQL:
+            raise Exception("fetchChunkRows requires ExecuteSql to be the last action of the check")
+         self._executeSql(sql,
+                          isTimeSeries,
+                          initialTimespanSecs,
+                          catchUpWindowSecs,
+                          fetchChunkRows,
+                          tenantFanOut)
+         self.tracer.info("[%s] successfully ran SQL for check, result will be fetched in chunks of %d rows" % (self.fullName,
+                                                                                                            fetchChunkRows))
+         return
 
-      # Prepare SQL statement
-      preparedSql = self._prepareSql(sql,
-                                     isTimeSeries,
-                                     initialTimespanSecs)
-      if not preparedSql:
-         raise Exception("Unable to prepare SQL statement")
-
-      # Execute SQL statement
-      self.tracer.debug("[%s] executing SQL statement %s" % (self.fullName,
-                                                             preparedSql))
-      cursor.execute(preparedSql)
-      colIndex = {col[0] : idx for idx, col in enumerate(cursor.description)}
-      resultRows = cursor.fetchall()
+      batchResult = None
+      if self.providerInstance.batchExecution:
+         batchResult = self.providerInstance.takeBatchResult(self)
+      if batchResult:
+         self.tracer.info("[%s] using SQL result from batch" % self.fullName)
+         (colIndex, resultRows) = batchResult
+      else:
+         (colIndex, resultRows) = self._executeSql(sql,
+                                                   isTimeSeries,
+                                                   initialTimespanSecs,
+                                                   catchUpWindowSecs,
+                                                   tenantFanOut = tenantFanOut)
 
       self.lastResult = (colIndex, resultRows)
       self.tracer.debug("[%s] lastResult.colIndex=%s" % (self.fullName,
@@ -383,12 +1231,85 @@ class saphanaProviderCheck(ProviderCheck):
       if not self.updateState():
          raise Exception("Failed to update state")
 
-      # Disconnect from HANA server to avoid memory leaks
-      self.tracer.debug("[%s] closing HANA connection" % self.fullName)
-      connection.close()
-
       self.tracer.info("[%s] successfully ran SQL for check" % self.fullName)
 
+   # Connect to HANA and run the check-specific SQL statement on a session of its own
+   # Returns (colIndex, resultRows); if the result is to be fetched in chunks, the session is kept
+   # open as the result stream of this check instead and no rows are returned
+   def _executeSql(self,
+                   sql: str,
+                   isTimeSeries: bool,
+                   initialTimespanSecs: int,
+                   catchUpWindowSecs: int = None,
+                   fetchChunkRows: int = None,
+                   tenantFanOut: bool = False) -> Tuple[Dict[str, int], List[List[object]]]:
+      self.tracer.info("[%s] connecting to HANA and executing SQL" % self.fullName)
+
+      # Find and connect to HANA server (or reuse a pooled connection)
+      (connection, cursor, host) = self._getHanaConnection()
+      if not connection:
+         raise Exception("Unable to get HANA connection")
+
+      # Prepare SQL statement (after connecting, as it depends on the topology loaded by then)
+      # and execute it
+      try:
+         cursor.close()
+         (preparedSql, parameters) = self._prepareSql(sql,
+                                                      isTimeSeries,
+                                                      initialTimespanSecs,
+                                                      catchUpWindowSecs,
+                                                      tenantFanOut)
+         if not preparedSql:
+            raise Exception("Unable to prepare SQL statement")
+         if fetchChunkRows:
+            (cursor, colIndex) = self._executeStatement(connection, preparedSql, parameters)
+            self.resultStream = (connection, cursor, host, colIndex, fetchChunkRows)
+            self.lastResult = (colIndex, [])
+            return (colIndex, None)
+         result = self._fetchSqlResult(connection, preparedSql, parameters)
+      except Exception:
+         # The connection might be broken, so do not hand it back to the pool
+         self.providerInstance.connectionPool.discard(connection)
+         raise
+
+      # Hand the connection back to the pool, so the next check does not need to log on again
+      self.providerInstance.connectionPool.checkin(connection, host)
+      return result
+
+   # Query the landscape host configuration live by refreshing the topology (which it is part of),
+   # so the cached topology is kept current as well, and take the host configuration from it
+   def _actionLoadHostConfig(self) -> None:
+      self.tracer.info("[%s] loading HANA host configuration" % self.fullName)
+      topology = self.providerInstance.getTopology()
+      refreshedAt = topology.get("refreshedAt", None) if topology else None
+      (connection, cursor, host) = self._getHanaConnection()
+      if not connection:
+         raise Exception("Unable to get HANA connection")
+      try:
+         cursor.close()
+         # Connecting may have refreshed the topology already
+         topology = self.providerInstance.getTopology()
+         if not topology or not topology.get("refreshedAt", None) or topology["refreshedAt"] == refreshedAt:
+            if not self.providerInstance.refreshTopology(connection, force = True):
+               raise Exception("Unable to query HANA host configuration")
+      except Exception:
+         self.providerInstance.connectionPool.discard(connection)
+         raise
+      self.providerInstance.connectionPool.checkin(connection, host)
+      topology = self.providerInstance.getTopology()
+
+      # For this check, the column storing the local UTC will be used for TimeGenerated
+      # (the time the host configuration has been queried at)
+      self.colTimeGenerated = COL_LOCAL_UTC
+      colIndex = {c: idx + 1 for (idx, c) in enumerate(topology["hostConfigColumns"])}
+      colIndex[COL_LOCAL_UTC] = 0
+      self.columnTypes = None
+      self.lastResult = (colIndex, [[topology["refreshedAt"]] + r for r in topology["hostConfigRows"]])
+
+      # Update internal state
+      if not self.updateState():
+         raise Exception("Failed to update state")
+
    # Parse result of the query against M_LANDSCAPE_HOST_CONFIGURATION and store it internally
    def _actionParseHostConfig(self) -> None:
       self.tracer.info("[%s] parsing HANA host configuration and storing it in provider state" % self.fullName)
@@ -407,46 +1328,34 @@ class saphanaProviderCheck(ProviderCheck):
       self.providerInstance.state["hostConfig"] = hosts
       self.tracer.debug("hosts=%s" % hosts)
 
-   # Probe SQL Connection to all nodes in HANA landscape
-   def _actionProbeSqlConnection(self,
-                                 probeTimeout: int = None) -> None:
-      self.tracer.info("[%s] probing SQL connection to all HANA nodes" % self.fullName)
+   # Probe the indexserver (SQL) port and, if that fails, the nameserver port of a single HANA node
+   # Returns the probing result row [local UTC, host, success, latency in ms]
+   def _probeHost(self,
+                  host: str,
+                  probeMode: str,
+                  timeoutSecs: int) -> List[object]:
+      latency = None
+      success = False
 
-      # If no probeTimeout parameter is defined for this action, use the default
-      if probeTimeout is None:
-         probeTimeout = const.TIMEOUT_HANA_MS
+      # Given the SQL port (3xxyy), calculate hdbnameserver port (3xx01)
+      portSQL = self.providerInstance.hanaDbSqlPort
+      portNameserver = int(str(portSQL)[:-2] + "01")
 
-      # For this check, the column storing the local UTC will be used for TimeGenerated
-      self.colTimeGenerated = COL_LOCAL_UTC
-
-      # This check requires the HANA host configuration to be run first
-      if "hostConfig" not in self.providerInstance.state:
-         raise Exception("HANA host config check has not been executed yet")
-
-      # Iterate through all hosts (alphabetical order) from the host config
-      hostConfig = self.providerInstance.state["hostConfig"]
-      hostsToProbe = [h["host"] for h in hostConfig]
-      probeResults = []
-      for host in sorted(hostsToProbe):
-         latency = None
-         success = False
-
-         # Given the SQL port (3xxyy), calculate hdbnameserver port (3xx01)
-         portSQL = self.providerInstance.hanaDbSqlPort
-         portNameserver = int(str(portSQL)[:-2] + "01")
-
-         for port in (portSQL, portNameserver):
-            # Probe connection to Indexserver (SQL) and Nameserver of a particular node
-            # This Nameserver workaround is required, since in a n+m scale-out scenario (with m>0),
-            # stand-by nodes will have no hdbindexserver running, hence SQL connection will fail.
-            startTime = time.time()
+      for port in (portSQL, portNameserver):
+         # Probe connection to Indexserver (SQL) and Nameserver of a particular node
+         # This Nameserver workaround is required, since in a n+m scale-out scenario (with m>0),
+         # stand-by nodes will have no hdbindexserver running, hence SQL connection will fail.
+         startTime = time.time()
+         self.tracer.debug("[%s] probing HANA connection at %s:%d" % (self.fullName,
+                                                                      host,
+                                                                      port))
+         if probeMode == PROBE_MODE_TCP:
+            success = TCP.probe(self.tracer, host, port, timeoutSecs)
+         else:
             try:
-               self.tracer.debug("[%s] probing HANA connection at %s:%d" % (self.fullName,
-                                                                            host,
-                                                                            port))
                connection = self.providerInstance._establishHanaConnectionToHost(hostname = host,
                                                                                  port = port,
-                                                                                 timeout = probeTimeout)
+                                                                                 timeout = timeoutSecs)
                if connection.isconnected():
                   self.tracer.debug("[%s] HANA connection successfully established" % self.fullName)
                   success = True
@@ -455,7 +1364,7 @@ class saphanaProviderCheck(ProviderCheck):
                # We know that SQL connections to hdbnameserver will fail
                # Let's determine if the HANA landscape is up, based on the error code
                # (Note: this applies to scale-out landscapes with n+m nodes only)
-               msg = e.errortext.lower()
+               msg = getattr(e, "errortext", str(e)).lower()
                if "89008" in msg or "socket closed" in msg:
                   success = True
                   self.tracer.debug("[%s] received expected error probing HANA nameserver %s:%d (%s" % (self.fullName,
@@ -474,23 +1383,53 @@ class saphanaProviderCheck(ProviderCheck):
                                                                                                         host,
                                                                                                         portNameserver,
                                                                                                         e))
-            if success:
-               latency = (time.time() - startTime) * 1000
-               break
+         if success:
+            latency = (time.time() - startTime) * 1000
+            break
 
-         # Build probing result tuple with current local time
-         probeResults.append(
-               [
-                  datetime.utcnow(),
-                  host,
-                  success,
-                  latency
-               ]
-            )
+      # Build probing result tuple with current local time
+      return [
+         datetime.utcnow(),
+         host,
+         success,
+         latency
+      ]
+
+   # Probe SQL Connection to all nodes in HANA landscape
+   # The nodes are probed concurrently (at most maxParallelProbes at a time), either with a full
+   # SQL login (probeMode "login") or with a plain TCP connect to their ports (probeMode "tcp")
+   def _actionProbeSqlConnection(self,
+                                 probeTimeout: int = None,
+                                 probeMode: str = PROBE_MODE_LOGIN,
+                                 maxParallelProbes: int = PROBE_MAX_PARALLEL) -> None:
+      self.tracer.info("[%s] probing SQL connection to all HANA nodes (probeMode=%s)" % (self.fullName,
+                                                                                         probeMode))
+
+      # If no probeTimeout parameter (in ms) is defined for this action, use the default
+      if probeTimeout is None:
+         probeTimeout = TIMEOUT_HANA_SECS * 1000
+      if probeMode not in (PROBE_MODE_LOGIN, PROBE_MODE_TCP):
+         raise Exception("probeMode must be %s or %s" % (PROBE_MODE_LOGIN, PROBE_MODE_TCP))
+
+      # For this check, the column storing the local UTC will be used for TimeGenerated
+      self.colTimeGenerated = COL_LOCAL_UTC
+
+      # This check requires the HANA host configuration to be run first
+      if "hostConfig" not in self.providerInstance.state:
+         raise Exception("HANA host config check has not been executed yet")
+
+      # Probe all hosts from the host config; results are kept in alphabetical order
+      hostConfig = self.providerInstance.state["hostConfig"]
+      hostsToProbe = sorted([h["host"] for h in hostConfig])
+      timeoutSecs = self.boundedTimeout(max(1, probeTimeout // 1000))
+      with ThreadPoolExecutor(max_workers = max(1, min(maxParallelProbes, len(hostsToProbe)))) as executor:
+         probeResults = list(executor.map(lambda host: self._probeHost(host, probeMode, timeoutSecs),
+                                          hostsToProbe))
 
       # Store complete probing result internally and update state
       self.tracer.debug("[%s] probeResults=%s" % (self.fullName,
                                                   probeResults))
+      self.columnTypes = None
       self.lastResult = (
             {
                COL_LOCAL_UTC: 0,
@@ -0,0 +1,313 @@
+# Python modules
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+# Payload modules
+from .base import ProviderInstance, ProviderCheck
+from .workerpool import WorkerPool
+
+###############################################################################
+
+# Central, deadline-based scheduler for the checks of all provider instances
+# Checks are kept in a priority queue keyed by their next due time and dispatched to a
+# bounded worker pool; within the run window, checks with a short frequency are run repeatedly
+# Checks of the same provider instance run in parallel unless they depend on each other
+# Failed actions are not retried on the worker; the check is put back with a backoff instead,
+# so the worker is free to run other due checks in the meantime
+# Checks catching up on a backlog are put back right away (until the run deadline) to fetch
+# their next window
+class CheckScheduler(object):
+   tracer = None
+   runCheck = None
+   workerPool = None
+   windowSecs = None
+   deadlineSecs = None
+   maxChecksPerInstance = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                runCheck: Callable[[ProviderCheck], float],
+                workerPool: WorkerPool,
+                windowSecs: float = 0,
+                maxChecksPerInstance: int = 1,
+                deadlineSecs: float = None):
+      self.tracer = tracer
+      self.runCheck = runCheck
+      self.workerPool = workerPool
+      self.windowSecs = max(0, windowSecs)
+      self.deadlineSecs = deadlineSecs
+      self.maxChecksPerInstance = max(1, maxChecksPerInstance)
+      self._queue = []
+      # Checks waiting for the retry of a failed action or catching up (not bound to the run window)
+      self._retries = []
+      self._inProgress = set()
+      self._catchingUp = set()
+      self._sequence = itertools.count()
+      # Due times of all checks waiting to be dispatched (queued or deferred)
+      self._pendingDue = {}
+      # Checks waiting for a blocker (a check, provider instance or provider type) to finish
+      self._deferred = {}
+      self._dependencies = {}
+      self._runningChecks = set()
+      self._runningPerInstance = {}
+      self._running = 0
+      self._condition = threading.Condition()
+      self._stopped = False
+      self.stats = {}
+
+   # Add all enabled checks of the given provider instances to the queue
+   # (or only those named in checkNames, e.g. the checks of a dispatched work item)
+   def addInstances(self,
+                    instances: List[ProviderInstance],
+                    checkNames: List[str] = None) -> None:
+      now = time.monotonic()
+      for providerInstance in instances:
+         checksByName = {c.name: c for c in providerInstance.checks}
+         for check in providerInstance.checks:
+            if checkNames is not None and check.name not in checkNames:
+               continue
+            if not check.isEnabled():
+               continue
+            self._dependencies[check] = [checksByName[d] for d in check.dependsOn if d in checksByName]
+            self._push(now + check.secondsUntilDue(), check)
+         self.workerPool.registerChecks(providerInstance.checks)
+      return
+
+   # Dispatch due checks until the queue is empty or the run window has passed
+   # No check is started after the run deadline, and each check gets a deadline of its own
+   # Returns the statistics of this run
+   def run(self) -> Dict[str, int]:
+      startTime = time.monotonic()
+      windowEnd = startTime + self.windowSecs
+      runDeadline = None
+      if self.deadlineSecs:
+         runDeadline = startTime + self.deadlineSecs
+         windowEnd = min(windowEnd, runDeadline)
+      deadlineReached = False
+      self.stats = {
+         "dispatched": 0,
+         "failed": 0,
+         "cancelled": 0,
+         "retries": 0,
+         "missedDeadlines": 0,
+         "skippedDeadline": 0,
+         "maxLatenessSecs": 0
+      }
+      self.tracer.info("starting check scheduler (queued=%d, maxWorkers=%d, windowSecs=%d)" % (len(self._queue),
+                                                                                              self.workerPool.maxWorkers,
+                                                                                              self.windowSecs))
+      self.workerPool.start()
+      with ThreadPoolExecutor(max_workers = self.workerPool.maxWorkers) as pool:
+         with self._condition:
+            while True:
+               now = time.monotonic()
+               if runDeadline is not None and now >= runDeadline and not deadlineReached:
+                  self.tracer.warning("run deadline reached, not starting any further checks")
+                  deadlineReached = True
+                  self._unqueuePending()
+               if self._stopped and not deadlineReached:
+                  self.tracer.info("scheduler has been stopped, not starting any further checks")
+                  deadlineReached = True
+                  self._unqueuePending()
+               nextQueue = None if deadlineReached else self._nextQueue(windowEnd)
+               if not nextQueue:
+                  # Nothing else is due inside the run window; wait for running checks to finish
+                  # (deferred checks can only be released by a running check)
+                  if self._running == 0:
+                     break
+                  self._condition.wait()
+                  continue
+               (dueAt, _, check) = nextQueue[0]
+               if dueAt > now:
+                  self._condition.wait(timeout = dueAt - now)
+                  continue
+               if self._running >= self.workerPool.maxWorkers:
+                  self._condition.wait()
+                  continue
+               heapq.heappop(nextQueue)
+
+               blocker = self._findBlocker(check, min(now, windowEnd))
+               if blocker is not None:
+                  self._deferred.setdefault(blocker, []).append((dueAt, check))
+                  continue
+               if check not in self._inProgress:
+                  check.deadline = now + check.timeoutSecs if check.timeoutSecs else None
+                  if runDeadline is not None:
+                     check.deadline = min(check.deadline, runDeadline) if check.deadline else runDeadline
+                  self._accountLateness(check, now - dueAt)
+               self._dispatch(pool, check, windowEnd)
+
+      # Checks still waiting for a retry will not be resumed anymore
+      for check in self._inProgress:
+         check.abortRun()
+         self.stats["cancelled"] += 1
+
+      # Everything still waiting with a due time inside the window has been missed
+      # (or skipped, if the run deadline did not leave enough time to start it),
+      # unless the scheduler has been stopped
+      for (check, dueAt) in self._pendingDue.items():
+         if check in self._inProgress or check in self._catchingUp or self._stopped:
+            continue
+         if dueAt <= windowEnd:
+            if deadlineReached:
+               self.tracer.warning("[%s] check skipped due to run deadline" % check.fullName)
+               self.stats["skippedDeadline"] += 1
+            else:
+               self.tracer.warning("[%s] check could not be run inside the run window" % check.fullName)
+               self.stats["missedDeadlines"] += 1
+      self._unqueuePending()
+      self._queue = []
+      self._retries = []
+      self._inProgress = set()
+      self._catchingUp = set()
+      self._pendingDue = {}
+      self._deferred = {}
+      self.workerPool.shutdown()
+      self.tracer.info("check scheduler finished (%s)" % self.stats)
+      return self.stats
+
+   # Stop a running scheduler: no further checks are started, running checks are finished
+   # (safe to be called from a signal handler)
+   def stop(self) -> None:
+      with self._condition:
+         self._stopped = True
+         self._condition.notify_all()
+      return
+
+   # Pick the queue holding the next check to run: checks due inside the run window,
+   # or checks waiting for a retry or catching up (those are bound by the run deadline instead)
+   def _nextQueue(self,
+                  windowEnd: float) -> List[Tuple[float, int, ProviderCheck]]:
+      candidates = []
+      if self._queue and self._queue[0][0] <= windowEnd:
+         candidates.append(self._queue)
+      if self._retries:
+         candidates.append(self._retries)
+      if not candidates:
+         return None
+      return min(candidates, key = lambda q: q[0][0])
+
+   # Determine what (if anything) prevents a check from being started right now:
+   # - a check it depends on that is running, waiting for a retry or due itself (dependencies run first)
+   # - the limit of parallel checks of its provider instance
+   # - the concurrency limit of its provider type
+   def _findBlocker(self,
+                    check: ProviderCheck,
+                    dueBefore: float) -> object:
+      for dependency in self._dependencies.get(check, []):
+         if dependency in self._runningChecks or dependency in self._inProgress:
+            return dependency
+         dependencyDueAt = self._pendingDue.get(dependency, None)
+         if dependencyDueAt is not None and dependencyDueAt <= dueBefore:
+            return dependency
+      providerInstance = check.providerInstance
+      if self._runningPerInstance.get(providerInstance, 0) >= self.maxChecksPerInstance:
+         return providerInstance
+      if not self.workerPool.hasCapacity(providerInstance.providerType):
+         return providerInstance.providerType
+      return None
+
+   # Hand a check over to a worker
+   def _dispatch(self,
+                 pool: ThreadPoolExecutor,
+                 check: ProviderCheck,
+                 windowEnd: float) -> None:
+      providerInstance = check.providerInstance
+      del self._pendingDue[check]
+      check.queued = False
+      self._runningChecks.add(check)
+      self._runningPerInstance[providerInstance] = self._runningPerInstance.get(providerInstance, 0) + 1
+      self.workerPool.acquire(providerInstance.providerType)
+      self._running += 1
+      self.stats["dispatched"] += 1
+      pool.submit(self._execute, check, windowEnd)
+      return
+
+   # Run a single check on a worker and put it back into the queue if it is due again inside the window
+   def _execute(self,
+                check: ProviderCheck,
+                windowEnd: float) -> None:
+      startTime = time.monotonic()
+      retryDelay = None
+      failed = False
+      try:
+         retryDelay = self.workerPool.execute(self.runCheck, check)
+      except Exception as e:
+         self.tracer.error("[%s] unhandled error while running check (%s)" % (check.fullName, e))
+         check.abortRun()
+         failed = True
+         with self._condition:
+            self.stats["failed"] += 1
+      with self._condition:
+         self._running -= 1
+         self._catchingUp.discard(check)
+         providerInstance = check.providerInstance
+         self._runningChecks.discard(check)
+         self._runningPerInstance[providerInstance] -= 1
+         self.workerPool.release(providerInstance.providerType)
+         for blocker in (providerInstance, providerInstance.providerType):
+            for (dueAt, deferredCheck) in self._deferred.pop(blocker, []):
+               self._push(dueAt, deferredCheck)
+
+         # Park the check until its failed action is due to be retried
+         if retryDelay is not None:
+            self.stats["retries"] += 1
+            self._inProgress.add(check)
+            self._push(time.monotonic() + retryDelay, check)
+            self._condition.notify_all()
+            return
+         if check in self._inProgress:
+            self._inProgress.discard(check)
+         if check.cancelled:
+            self.stats["cancelled"] += 1
+         for (dueAt, deferredCheck) in self._deferred.pop(check, []):
+            self._push(dueAt, deferredCheck)
+
+         # Fetch the next window of a backlog right away
+         if check.catchingUp and not failed and not check.cancelled:
+            self.tracer.info("[%s] check is catching up, running it again" % check.fullName)
+            self._catchingUp.add(check)
+            self._push(time.monotonic(), check)
+            self._condition.notify_all()
+            return
+
+         # Failed checks do not update their last run time, so count the frequency from this start
+         nextDueAt = max(time.monotonic() + check.secondsUntilDue(),
+                         startTime + check.frequencySecs)
+         if nextDueAt <= windowEnd:
+            self._push(nextDueAt, check)
+         self._condition.notify_all()
+      return
+
+   # Missed deadlines are counted in full frequency periods the check has been started late
+   def _accountLateness(self,
+                        check: ProviderCheck,
+                        latenessSecs: float) -> None:
+      self.stats["maxLatenessSecs"] = max(self.stats["maxLatenessSecs"], int(latenessSecs))
+      if check.frequencySecs and latenessSecs >= check.frequencySecs:
+         missed = int(latenessSecs // check.frequencySecs)
+         self.tracer.warning("[%s] check started %ds late, missed %d deadline(s)" % (check.fullName,
+                                                                                    latenessSecs,
+                                                                                    missed))
+         self.stats["missedDeadlines"] += missed
+      return
+
+   # Mark all checks that are still waiting as no longer queued (they will not be run by this scheduler)
+   def _unqueuePending(self) -> None:
+      for check in self._pendingDue:
+         check.queued = False
+      return
+
+   def _push(self,
+             dueAt: float,
+             check: ProviderCheck) -> None:
+      self._pendingDue[check] = dueAt
+      check.queued = True
+      queue = self._retries if check in self._inProgress or check in self._catchingUp else self._queue
+      heapq.heappush(queue, (dueAt, next(self._sequence), check))
+      return
@@ -1,12 +1,22 @@
 # Python modules
 from datetime import date, datetime
 import decimal
+import hashlib
 import http.client as http_client
 import json
+import math
+import re
 import requests
-from typing import Callable, Dict, Optional
+import socket
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from binascii import hexlify
 
+# Optional fast JSON backend (the standard library is used if it is not installed)
+try:
+   import orjson
+except ImportError:
+   orjson = None
+
 # Payload modules
 from .const import *
 
@@ -54,19 +64,315 @@ class REST:
 
 ###############################################################################
 
+# Provide cheap reachability checks of TCP endpoints
+class TCP:
+   @staticmethod
+   def probe(tracer: logging.Logger,
+             host: str,
+             port: int,
+             timeout: int = 2) -> bool:
+      try:
+         with socket.create_connection((host, port), timeout = timeout):
+            return True
+      except Exception as e:
+         tracer.debug("could not open TCP connection to %s:%d (%s)" % (host, port, e))
+         return False
+
+###############################################################################
+
+# Incremental MD5 hash over the rows of a (SQL) result set, fed row by row as they are fetched
+# Each value is hashed as canonical, type-tagged bytes, so the digest is the same for any
+# driver-specific row type and e.g. 1, 1.0 and "1" do not collide; optionally, the digest of
+# every single row is kept as well (for row-level diffing)
+class RowHasher(object):
+   columns = None
+   rowCount = 0
+   rowDigests = None
+
+   def __init__(self,
+                columns: List[int] = None,
+                keepRowDigests: bool = False):
+      self.columns = columns
+      self.rowCount = 0
+      self.rowDigests = [] if keepRowDigests else None
+      self._hash = hashlib.md5()
+
+   # Add a single row (only the given columns, if any) to the hash
+   def update(self,
+              row: List[object]) -> None:
+      values = row if self.columns is None else [row[idx] for idx in self.columns]
+      rowBytes = b"".join([self._canonicalBytes(v) for v in values])
+      self._hash.update(b"%d:" % len(rowBytes))
+      self._hash.update(rowBytes)
+      if self.rowDigests is not None:
+         self.rowDigests.append(hashlib.md5(rowBytes).hexdigest())
+      self.rowCount += 1
+      return
+
+   # Add several rows (e.g. a chunk returned by fetchmany) to the hash
+   def updateRows(self,
+                  rows: List[List[object]]) -> None:
+      for row in rows:
+         self.update(row)
+      return
+
+   # Hex digest of all rows added so far
+   def hexdigest(self) -> str:
+      return self._hash.hexdigest()
+
+   # Encode a single value as type tag, length and canonical representation
+   @staticmethod
+   def _canonicalBytes(value: object) -> bytes:
+      if value is None:
+         return b"N;"
+      if isinstance(value, bool):
+         (tag, data) = (b"B", b"1" if value else b"0")
+      elif isinstance(value, int):
+         (tag, data) = (b"I", str(value).encode("ascii"))
+      elif isinstance(value, float):
+         (tag, data) = (b"F", repr(value).encode("ascii"))
+      elif isinstance(value, decimal.Decimal):
+         (tag, data) = (b"D", str(value.normalize()).encode("ascii"))
+      elif isinstance(value, datetime):
+         (tag, data) = (b"T", value.isoformat().encode("ascii"))
+      elif isinstance(value, date):
+         (tag, data) = (b"d", value.isoformat().encode("ascii"))
+      elif isinstance(value, str):
+         (tag, data) = (b"S", value.encode("utf-8"))
+      elif isinstance(value, (bytes, bytearray, memoryview)):
+         (tag, data) = (b"X", bytes(value))
+      elif hasattr(value, "isoformat"):
+         (tag, data) = (b"t", value.isoformat().encode("ascii"))
+      else:
+         (tag, data) = (b"O", repr(value).encode("utf-8"))
+      return b"%s%d:%s;" % (tag, len(data), data)
+
+###############################################################################
+
+# Column-wise conversion of (SQL) result rows into JSON-serializable dictionaries
+# The conversion plan (name, column index and value converter of each column to keep) is built
+# once per result set, so rows are converted without checking the type of every single value;
+# the fields of the template are added to every converted row
+class RowConverter(object):
+   plan = None
+   template = None
+
+   def __init__(self,
+                plan: List[Tuple[str, int, Callable]],
+                template: Dict[str, object] = None):
+      self.plan = plan
+      self.template = template if template else {}
+      self._plainColumns = [(name, idx) for (name, idx, converter) in plan if not converter]
+      self._convertedColumns = [(name, idx, converter) for (name, idx, converter) in plan if converter]
+
+   # Convert a single row
+   def convert(self,
+               row: List[object]) -> Dict[str, object]:
+      item = self.template.copy()
+      for (name, idx) in self._plainColumns:
+         item[name] = row[idx]
+      for (name, idx, converter) in self._convertedColumns:
+         value = row[idx]
+         item[name] = None if value is None else converter(value)
+      return item
+
+   # Convert several rows (e.g. a chunk returned by fetchmany)
+   def convertRows(self,
+                   rows: List[List[object]]) -> List[Dict[str, object]]:
+      return [self.convert(row) for row in rows]
+
+###############################################################################
+
+# JSON representation of values that the json module cannot serialize
+# (used by JsonEncoder and as value converters of a RowConverter)
+def jsonDecimal(o: decimal.Decimal) -> float:
+   return float(o)
+
+def jsonDatetime(o: date) -> str:
+   return o.strftime(TIME_FORMAT_JSON)
+
+def jsonBytes(o: bytes) -> str:
+   s = hexlify(o).decode("ascii")
+   return "0x%s" % s.upper()
+
 # Helper class to serialize datetime and Decimal objects into JSON
 class JsonEncoder(json.JSONEncoder):
    # Overwrite encoder for Decimal and datetime objects
    def default(self,
                o: object) -> object:
       if isinstance(o, decimal.Decimal):
-         return float(o)
+         return jsonDecimal(o)
+      elif isinstance(o, (datetime, date)):
+         return jsonDatetime(o)
+      elif isinstance(o, bytes):
+         return jsonBytes(o)
+      return super(JsonEncoder, self).default(o)
+
+# Encode records into compact JSON arrays, record by record, and cut them into chunks of at most
+# maxChunkBytes (each chunk is a JSON array of its own), so the JSON of a large result set is never
+# built as one string; a single record that exceeds the limit makes up a chunk on its own
+# The output is ASCII (non-ASCII characters are escaped), so its length in bytes equals its length
+class JsonChunkEncoder(object):
+   maxChunkBytes = None
+   sortKeys = True
+
+   def __init__(self,
+                maxChunkBytes: int = INGEST_MAX_CHUNK_BYTES,
+                sortKeys: bool = True):
+      self.maxChunkBytes = maxChunkBytes
+      self.sortKeys = sortKeys
+      self._items = []
+      self._size = 1
+
+   # Add a single record; returns the completed chunk if the record did not fit into it anymore
+   def add(self,
+           record: object) -> Optional[str]:
+      item = JsonBackend.dumps(record,
+                               sortKeys = self.sortKeys,
+                               separators = (",", ":"))
+      chunk = None
+      # The size of a chunk is that of its records, plus one separator each and the brackets
+      if self._items and self.maxChunkBytes and self._size + len(item) + 1 > self.maxChunkBytes:
+         chunk = self.flush()
+      self._items.append(item)
+      self._size += len(item) + 1
+      return chunk
+
+   # Return the chunk of the records added since the last chunk (None if there are none)
+   def flush(self) -> Optional[str]:
+      if not self._items:
+         return None
+      chunk = "[%s]" % ",".join(self._items)
+      self._items = []
+      self._size = 1
+      return chunk
+
+   # Encode all records, one chunk at a time (at least one chunk, i.e. an empty array if there are no records)
+   def encode(self,
+              records: Iterable[object]) -> Iterator[str]:
+      empty = True
+      for record in records:
+         chunk = self.add(record)
+         if chunk:
+            empty = False
+            yield chunk
+      chunk = self.flush()
+      if chunk or empty:
+         yield chunk if chunk else "[]"
+
+# JSON backend of the payload: uses orjson, if installed, and the standard library otherwise
+# Its output is the same, byte for byte, as that of the json module with JsonEncoder (and the same
+# options): orjson is only used for compact JSON, gets the conversions of JsonEncoder as default hook
+# and its output is discarded whenever the json module would have encoded it differently (characters
+# that are escaped by the json module, floats in exponent notation) or it cannot encode an object
+# (e.g. integers beyond 64 bits); NaN and infinite floats are encoded as null by both (instead of
+# tokens that are not valid JSON)
+# JSON is decoded by orjson as well, with the object hook applied to the decoded objects afterwards,
+# unless it may contain integers beyond 64 bits (which orjson decodes into floats)
+class JsonBackend(object):
+   name = "orjson" if orjson else "json"
+
+   # Digits (and the characters a number can follow) are folded into one each to find the numbers
+   # of orjson output that differ from that of the json module
+   _NUMBER_FOLDING = bytes.maketrans(b"0123456789,[-", b"0000000000:::")
+   _REGEX_LONG_DIGITS = re.compile("[0-9]{19}")
+
+   # Serialize an object into a JSON-encoded string
+   @staticmethod
+   def dumps(obj: object,
+             sortKeys: bool = False,
+             indent: int = None,
+             separators: Tuple[str, str] = None) -> str:
+      if orjson and indent is None and separators == (",", ":"):
+         try:
+            jsonBytes = orjson.dumps(obj,
+                                     default = JsonBackend._orjsonDefault,
+                                     option = orjson.OPT_PASSTHROUGH_DATETIME | (orjson.OPT_SORT_KEYS if sortKeys else 0))
+            if JsonBackend._isStdlibCompatible(jsonBytes):
+               return jsonBytes.decode("ascii")
+         except TypeError:
+            pass
+      try:
+         return json.dumps(obj,
+                           sort_keys = sortKeys,
+                           indent = indent,
+                           separators = separators,
+                           allow_nan = False,
+                           cls = JsonEncoder)
+      except ValueError:
+         # NaN or infinite floats, which are encoded as null (like orjson does)
+         return json.dumps(JsonBackend._replaceNonFinite(obj),
+                           sort_keys = sortKeys,
+                           indent = indent,
+                           separators = separators,
+                           allow_nan = False,
+                           cls = JsonEncoder)
+
+   # De-serialize a JSON-encoded string (or bytes), applying the object hook (if any) to every
+   # decoded object, innermost first (like the object_hook of the json module)
+   @staticmethod
+   def loads(data: str,
+             objectHook: Callable = None) -> object:
+      if isinstance(data, (bytes, bytearray)):
+         data = data.decode("utf-8")
+      if orjson and not JsonBackend._REGEX_LONG_DIGITS.search(data):
+         try:
+            obj = orjson.loads(data)
+         except ValueError:
+            pass
+         else:
+            return JsonBackend._applyObjectHook(obj, objectHook) if objectHook else obj
+      return json.loads(data, object_hook = objectHook)
+
+   # Check if the output of orjson is the same as that of the json module, i.e. it has neither raw
+   # non-ASCII or DEL characters nor numbers in exponent notation or with an absolute value below
+   # 1e-4 (which the json module encodes in exponent notation); strings that look like such
+   # numbers only cost a fallback
+   @staticmethod
+   def _isStdlibCompatible(jsonBytes: bytes) -> bool:
+      if not jsonBytes.isascii() or b"\x7f" in jsonBytes:
+         return False
+      folded = jsonBytes.translate(JsonBackend._NUMBER_FOLDING)
+      return b"0e" not in folded and b":0.0000" not in folded and not folded.startswith(b"0.0000")
+
+   # Encode the objects that orjson does not support (or passes through) like JsonEncoder does
+   @staticmethod
+   def _orjsonDefault(o: object) -> object:
+      if isinstance(o, decimal.Decimal):
+         return jsonDecimal(o)
       elif isinstance(o, (datetime, date)):
-         return datetime.strftime(o, TIME_FORMAT_JSON)
+         return jsonDatetime(o)
       elif isinstance(o, bytes):
-         s = hexlify(o).decode("ascii")
-         return "0x%s" % s.upper()
-      return super(_JsonEncoder, self).default(o)      
+         return jsonBytes(o)
+      raise TypeError
+
+   # Replace NaN and infinite floats (and Decimals) of an object by None, recursively
+   @staticmethod
+   def _replaceNonFinite(obj: object) -> object:
+      if isinstance(obj, dict):
+         return {k: JsonBackend._replaceNonFinite(v) for (k, v) in obj.items()}
+      elif isinstance(obj, (list, tuple)):
+         return [JsonBackend._replaceNonFinite(v) for v in obj]
+      elif isinstance(obj, float) and not math.isfinite(obj):
+         return None
+      elif isinstance(obj, decimal.Decimal) and not obj.is_finite():
+         return None
+      return obj
+
+   # Apply an object hook to all objects (dicts) of a decoded JSON document, innermost first
+   @staticmethod
+   def _applyObjectHook(obj: object,
+                        objectHook: Callable) -> object:
+      if isinstance(obj, dict):
+         for (k, v) in obj.items():
+            if isinstance(v, (dict, list)):
+               obj[k] = JsonBackend._applyObjectHook(v, objectHook)
+         return objectHook(obj)
+      if isinstance(obj, list):
+         for (i, v) in enumerate(obj):
+            if isinstance(v, (dict, list)):
+               obj[i] = JsonBackend._applyObjectHook(v, objectHook)
+      return obj
 
 # Helper class to de-serialize JSON into datetime and Decimal objects
 class JsonDecoder(json.JSONDecoder):
@@ -77,6 +77,9 @@ class tracing:
          record.payloadversion = PAYLOAD_VERSION
          return record
       tracer.info("adding storage queue log handler")
+
+      # A warm worker may re-initialize the context with the same tracer; drop stale handlers
+      tracing.removeQueueLogHandlers(tracer)
       try:
          storageQueue = AzureStorageQueue(tracer,
                                           ctx.sapmonId,
@@ -122,9 +125,18 @@ class tracing:
            return
 
        logger = logging.getLogger("customerMetricsLogger")
+       tracing.removeQueueLogHandlers(logger)
        logger.addHandler(customerMetricsLogHandler)
        return logger
 
+   # Remove all storage queue log handlers from a logger
+   @staticmethod
+   def removeQueueLogHandlers(logger: logging.Logger) -> None:
+      for handler in list(logger.handlers):
+         if isinstance(handler, QueueStorageHandler):
+            logger.removeHandler(handler)
+      return
+
    # Ingest metrics into customer analytics
    @staticmethod
    def ingestCustomerAnalytics(tracer: logging.Logger,
@@ -132,25 +144,31 @@ class tracing:
                                customLog: str,
                                resultJson: str) -> None:
       tracer.info("sending customer analytics")
-      results = json.loads(resultJson)
+      results = JsonBackend.loads(resultJson)
       for result in results:
          metrics = {
             "Type": customLog,
             "Data": result,
          }
-         j = json.dumps(metrics)
+         j = JsonBackend.dumps(metrics)
          ctx.analyticsTracer.debug(j)
       return
 
    # Fetches the storage access keys from keyvault or directly from storage account
+   # (the key is memoized in the context, so both queue handlers share one lookup)
    @staticmethod
    def getAccessKeys(tracer: logging.Logger, ctx) -> str:
+      if ctx.storageAccessKey:
+         return ctx.storageAccessKey
       try :
          tracer.info("fetching queue access keys from key vault")
-         kv = AzureKeyVault(tracer,
-                            KEYVAULT_NAMING_CONVENTION % ctx.sapmonId,
-                            ctx.msiClientId)
-         return kv.getSecret(STORAGE_ACCESS_KEY_NAME).value
+         kv = ctx.azKv
+         if not kv:
+            kv = AzureKeyVault(tracer,
+                               KEYVAULT_NAMING_CONVENTION % ctx.sapmonId,
+                               ctx.msiClientId)
+         ctx.storageAccessKey = kv.getSecret(STORAGE_ACCESS_KEY_NAME).value
+         return ctx.storageAccessKey
       except Exception as e:
          tracer.warning("unable to get access keys from key vault, fetching from storage account (%s) " % e)
 
@@ -160,4 +178,5 @@ class tracing:
                                        ctx.vmInstance["subscriptionId"],
                                        ctx.vmInstance["resourceGroupName"],
                                        CUSTOMER_METRICS_QUEUE_NAMING_CONVENTION % ctx.sapmonId)
-      return storageQueue.getAccessKey()
+      ctx.storageAccessKey = storageQueue.getAccessKey()
+      return ctx.storageAccessKey
@@ -0,0 +1,166 @@
+# Python modules
+import logging
+import multiprocessing
+import threading
+from typing import Callable, Dict, List, Tuple
+
+# Payload modules
+from .base import ProviderCheck
+
+###############################################################################
+
+WORKER_POOL_THREAD  = "thread"
+WORKER_POOL_PROCESS = "process"
+
+# Checks that can be executed in a worker process (inherited by the forked workers)
+_processChecks = {}
+
+# Entry point of a forked worker process: locks held by other threads of the parent at the time
+# of the fork would never be released in here, so the provider instances get fresh ones
+# State files are only written by the parent (the state of a worker process is a stale copy)
+def _initWorkerProcess() -> None:
+   for providerInstance in set([c.providerInstance for c in _processChecks.values()]):
+      providerInstance.reinitAfterFork()
+      providerInstance.deferStateWrites = True
+   return
+
+# Run a check inside a worker process with the state handed over by the parent
+# and return the updated check and provider instance state, whether the check has been cancelled
+# or is catching up, its progress and delay if one of its actions is waiting for a retry, and
+# whether the state has to be written
+# Retries are not waited for in here (that would hold a worker process); the parent scheduler
+# resumes the check later, possibly in another worker process, so a retry starts over with the
+# first action unless the first action is the one to be retried
+def _runCheckInProcess(runCheck: Callable[[ProviderCheck], float],
+                       checkFullName: str,
+                       deadline: float,
+                       runState: Dict[str, object],
+                       checkState: Dict[str, object],
+                       instanceState: Dict[str, object]) -> Tuple[Dict[str, object], Dict[str, object], bool, bool, Dict[str, object], float, bool]:
+   check = _processChecks[checkFullName]
+   check.deadline = deadline
+   check.state = checkState
+   check.providerInstance.state = instanceState
+   check.providerInstance.stateWriteDeferred = False
+   check.runState = runState if runState and runState["actionIndex"] == 0 else None
+   retryDelay = runCheck(check)
+   return (check.state, check.providerInstance.state, check.cancelled, check.catchingUp, check.runState, retryDelay,
+           check.providerInstance.stateWriteDeferred)
+
+###############################################################################
+
+# Bounded worker pool shared by all provider instances
+# Enforces a global limit and per-provider-type limits of concurrently running checks;
+# checks run on the scheduler's threads, or optionally in a pool of worker processes
+class WorkerPool(object):
+   tracer = None
+   maxWorkers = None
+   providerTypeLimits = {}
+   poolType = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                maxWorkers: int,
+                providerTypeLimits: Dict[str, int] = None,
+                poolType: str = WORKER_POOL_THREAD):
+      self.tracer = tracer
+      self.maxWorkers = max(1, maxWorkers)
+      self.providerTypeLimits = providerTypeLimits if providerTypeLimits else {}
+      self.poolType = poolType
+      self._running = {}
+      self._lock = threading.Lock()
+      self._processPool = None
+      if self.poolType == WORKER_POOL_PROCESS:
+         # Worker processes need to inherit the provider instances, hence fork is required
+         if "fork" not in multiprocessing.get_all_start_methods():
+            self.tracer.warning("process worker pool requires fork, falling back to thread pool")
+            self.poolType = WORKER_POOL_THREAD
+      elif self.poolType != WORKER_POOL_THREAD:
+         self.tracer.warning("unknown worker pool type %s, using thread pool" % self.poolType)
+         self.poolType = WORKER_POOL_THREAD
+      self.tracer.info("initialized %s worker pool (maxWorkers=%d, providerTypeLimits=%s)" % (self.poolType,
+                                                                                              self.maxWorkers,
+                                                                                              self.providerTypeLimits))
+
+   # Make checks available to worker processes (must be called before they are forked)
+   def registerChecks(self,
+                      checks: List[ProviderCheck]) -> None:
+      if self.poolType == WORKER_POOL_PROCESS:
+         if self._processPool:
+            self.tracer.warning("worker processes have been started already, running checks on threads")
+            return
+         for check in checks:
+            _processChecks[check.fullName] = check
+      return
+
+   # Fork the worker processes (if any); to be called before the scheduler starts its threads,
+   # so no lock can be inherited in a locked state
+   # All workers are forked right away, not on demand while checks are running
+   def start(self) -> None:
+      if self.poolType != WORKER_POOL_PROCESS or self._processPool:
+         return
+      self.tracer.info("starting %d worker processes" % self.maxWorkers)
+      self._processPool = multiprocessing.get_context("fork").Pool(processes = self.maxWorkers,
+                                                                    initializer = _initWorkerProcess)
+      return
+
+   # Determine if another check of a provider type may be started right now
+   def hasCapacity(self,
+                   providerType: str) -> bool:
+      with self._lock:
+         if sum(self._running.values()) >= self.maxWorkers:
+            return False
+         limit = self.providerTypeLimits.get(providerType, None)
+         return limit is None or self._running.get(providerType, 0) < limit
+
+   # Reserve a slot for a check of a provider type
+   def acquire(self,
+               providerType: str) -> None:
+      with self._lock:
+         self._running[providerType] = self._running.get(providerType, 0) + 1
+      return
+
+   # Release a slot previously reserved for a check of a provider type
+   def release(self,
+               providerType: str) -> None:
+      with self._lock:
+         self._running[providerType] -= 1
+      return
+
+   # Run a check (blocking the calling scheduler thread until it has finished or has to wait for a retry)
+   # Returns the delay until the check has to be resumed (None if it has finished)
+   def execute(self,
+               runCheck: Callable[[ProviderCheck], float],
+               check: ProviderCheck) -> float:
+      if not self._processPool or check.fullName not in _processChecks:
+         return runCheck(check)
+      instanceState = check.providerInstance.state
+      sentKeys = set(instanceState.keys())
+      result = self._processPool.apply_async(_runCheckInProcess,
+                                             (runCheck,
+                                              check.fullName,
+                                              check.deadline,
+                                              check.runState,
+                                              check.state,
+                                              instanceState))
+      (check.state, newInstanceState, check.cancelled, check.catchingUp, check.runState, retryDelay, writeState) = result.get()
+
+      # Other checks of the same instance may have updated its state meanwhile, so merge
+      # the changes instead of replacing the whole state (and write the merged state, if the
+      # check has asked for it)
+      with check.providerInstance.stateLock:
+         for key in sentKeys - set(newInstanceState.keys()):
+            instanceState.pop(key, None)
+         instanceState.update(newInstanceState)
+         if writeState:
+            check.providerInstance.writeState()
+      return retryDelay
+
+   # Stop the worker processes (if any)
+   def shutdown(self) -> None:
+      if self._processPool:
+         self._processPool.close()
+         self._processPool.join()
+         self._processPool = None
+      _processChecks.clear()
+      return
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Make the shared code importable as the package shared_code (as the function app does with __app__)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,97 @@
+# Parity tests of the JSON backend: its output must equal that of the json module with JsonEncoder,
+# whether orjson is installed or not
+from collections import OrderedDict
+from datetime import date, datetime
+import decimal
+import json
+import logging
+import math
+
+import pytest
+
+from shared_code import tools
+from shared_code.tools import JsonBackend, JsonEncoder
+
+COMPACT = (",", ":")
+
+RECORDS = [
+   {"b": 1, "a": 2, "c": {"z": None, "y": True, "x": False}},
+   {"timestamp": datetime(2020, 5, 17, 13, 45, 1, 123456), "day": date(2020, 5, 17)},
+   {"value": decimal.Decimal("12.50"), "tiny": decimal.Decimal("0.00001"), "huge": decimal.Decimal("1e22")},
+   {"float": 0.1, "small": 1e-05, "exp": 1e16, "neg": -0.0001, "int": -(2 ** 63)},
+   {"bigint": 2 ** 70},
+   {"text": "Grüße, 東京   \x7f \x00 \"quoted\" \\ /"},
+   {"numberLikeString": "0.00001", "exp": "1e5"},
+   [1, "two", 3.0, [], {}],
+   "plain string",
+   OrderedDict([("z", 1), ("a", 2)]),
+]
+
+# Expected output, i.e. that of the json module (with NaN and infinite floats as null)
+def stdlibDumps(obj, sortKeys = False, separators = None):
+   return json.dumps(obj, sort_keys = sortKeys, separators = separators, cls = JsonEncoder)
+
+@pytest.fixture(params = ["orjson", "json"])
+def backend(request, monkeypatch):
+   if request.param == "orjson":
+      pytest.importorskip("orjson")
+   else:
+      monkeypatch.setattr(tools, "orjson", None)
+   return request.param
+
+@pytest.mark.parametrize("record", RECORDS)
+@pytest.mark.parametrize("sortKeys", [True, False])
+def test_dumpsCompactMatchesStdlib(backend, record, sortKeys):
+   assert JsonBackend.dumps(record, sortKeys = sortKeys, separators = COMPACT) == stdlibDumps(record, sortKeys, COMPACT)
+
+@pytest.mark.parametrize("record", RECORDS)
+def test_dumpsDefaultSeparatorsMatchesStdlib(backend, record):
+   assert JsonBackend.dumps(record) == stdlibDumps(record)
+
+def test_dumpsKeyOrdering(backend):
+   record = {"b": {"d": 1, "c": 2}, "a": 3}
+   assert JsonBackend.dumps(record, sortKeys = True, separators = COMPACT) == '{"a":3,"b":{"c":2,"d":1}}'
+   assert JsonBackend.dumps(record, separators = COMPACT) == '{"b":{"d":1,"c":2},"a":3}'
+
+@pytest.mark.parametrize("separators", [COMPACT, None])
+def test_dumpsNonFiniteAsNull(backend, separators):
+   record = {"nan": math.nan, "inf": math.inf, "ninf": -math.inf,
+             "decimalNan": decimal.Decimal("NaN"), "list": [math.nan, 1.5], "tuple": (math.inf,)}
+   expected = stdlibDumps({"nan": None, "inf": None, "ninf": None,
+                           "decimalNan": None, "list": [None, 1.5], "tuple": [None]},
+                          True, separators)
+   assert JsonBackend.dumps(record, sortKeys = True, separators = separators) == expected
+
+def test_dumpsUnsupportedTypeRaises(backend):
+   with pytest.raises(TypeError):
+      JsonBackend.dumps({"set": {1, 2}}, separators = COMPACT)
+
+def test_loadsRoundTrip(backend):
+   data = '{"a":[1,2.5,"x",null],"big":123456789012345678901234567890,"b":{"c":true}}'
+   assert JsonBackend.loads(data) == json.loads(data)
+   hooked = JsonBackend.loads(data, objectHook = lambda o: dict(o, hooked = True))
+   assert hooked == json.loads(data, object_hook = lambda o: dict(o, hooked = True))
+
+@pytest.mark.parametrize("jsonBytes, compatible", [
+   (b'{"a":1,"b":[0.5,-2,1.25]}', True),
+   # Conservative: the json module encodes 0.0001 the same, but any number below 0.001 falls back
+   (b'{"a":0.0001}', False),
+   (b'{"a":1e+16}', False),
+   (b'{"a":1e-05}', False),
+   (b'{"a":[-0.00001]}', False),
+   (b'0.00001', False),
+   # Strings that look like such numbers only cost a fallback
+   (b'{"a":"0.00001"}', True),
+   (b'{"a":"1e5"}', False),
+   (b'["x",1e5]', False),
+   (b'{"a":"\xc3\xbc"}', False),
+   (b'{"a":"\x7f"}', False),
+])
+def test_isStdlibCompatible(jsonBytes, compatible):
+   assert JsonBackend._isStdlibCompatible(jsonBytes) is compatible
+
+def test_jsonFormatterKeepsWireFormat(backend):
+   from shared_code.const import JsonFormatter
+   record = logging.LogRecord("test", logging.INFO, "test.py", 1, "Grüße %s", None, None)
+   formatted = JsonFormatter({"pid": "process", "lineNum": "lineno"}).format(record)
+   assert formatted == json.dumps(OrderedDict([("lineNum", 1), ("pid", record.process), ("msg", "Grüße %s")]))